@@ -1,181 +1,436 @@
-import sys
-if sys.version_info < (3,0):
-    #python 2.7 behavior
-    import ConfigParser as configparser
-    import Queue as queue
-else:
-    import configparser
-    import queue
+import configparser
 import time
+import datetime
 import threading
-from threading import Thread, Lock, Condition
+from threading import Thread
 import re
 import os
 import random
-import socket
-from websocket import WebSocketConnectionClosedException
 
 
 from slackclient import SlackClient
-from slacker import Slacker
 
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
 import display_image
+import datasets
+import catalog
+import render
+import render_cache
+import file_scheduler
+import post_queue
+import catchup
+import fmmf
+import watching
+import path_classifier
+import rtm
+import dispatch
+import slack_gateway
+import encoding
+import digest
 import timezone
 import suntimes
     
 
 # Read in configuration from config.ini
 # Note that config.ini should never be versioned on git!!!
-config = configparser.ConfigParser()
+config = configparser.ConfigParser({'render_processes' : '0',
+                                    'fast_preview_channels' : '',
+                                    'render_cache_dir' : 'render_cache',
+                                    'render_cache_mb' : '500',
+                                    'catalog_db' : 'catalog.db',
+                                    'file_stable_seconds' : '3',
+                                    'post_queue_db' : 'post_queue.db',
+                                    'max_post_attempts' : '3',
+                                    'catchup_throttle_seconds' : '5',
+                                    'max_posts_per_hour' : '20',
+                                    'max_old_backlog' : '30',
+                                    'watch_mode' : 'scoped',
+                                    'watch_poll_seconds' : '60',
+                                    'rtm_url' : '',
+                                    'command_threads' : '4',
+                                    'slack_api_url' : 'https://slack.com/api',
+                                    'cache_renders' : 'true',
+                                    'render_timeout_seconds' : '300',
+                                    'digest_mode' : 'off',
+                                    'digest_minutes' : '60',
+                                    'digest_max_panels' : '16',
+                                    'show_max_targets' : '12'})
 config.read("config.ini")
 username = config.get('DEFAULT','username')
 token = config.get('DEFAULT', 'token')
 uid = config.get('DEFAULT', 'id')
 dropboxdir = os.path.normpath(config.get('DEFAULT', 'dropboxdir'))
+render_processes = config.getint('DEFAULT', 'render_processes') # 0 for one per core
+# channels (names or IDs) that get fast previews instead of full matplotlib plots
+fast_preview_channels = [chan.strip().upper() for chan in config.get('DEFAULT', 'fast_preview_channels').split(",") if len(chan.strip()) > 0]
+render_cache_dir = config.get('DEFAULT', 'render_cache_dir') # where rendered PNGs are kept
+render_cache_bytes = int(config.getfloat('DEFAULT', 'render_cache_mb') * 1024**2) # render cache budget
+catalog_db = config.get('DEFAULT', 'catalog_db') # SQLite catalog of reductions
+file_stable_seconds = config.getfloat('DEFAULT', 'file_stable_seconds') # how long new files need to stop changing before we post them
+post_queue_db = config.get('DEFAULT', 'post_queue_db') # SQLite queue of things to post
+max_post_attempts = config.getint('DEFAULT', 'max_post_attempts') # tries at posting something before giving up on it
+catchup_throttle_seconds = config.getfloat('DEFAULT', 'catchup_throttle_seconds') # time between files posted when catching up after a restart
+max_posts_per_hour = config.getint('DEFAULT', 'max_posts_per_hour') # limit on automatic posts. 0 for no limit
+max_old_backlog = config.getint('DEFAULT', 'max_old_backlog') # this many old reductions waiting get rolled up into one post
+watch_mode = config.get('DEFAULT', 'watch_mode').strip().lower() # scoped, recursive or poll
+watch_poll_seconds = config.getfloat('DEFAULT', 'watch_poll_seconds') # how often to poll what can't be watched
+rtm_url = config.get('DEFAULT', 'rtm_url').strip() # websocket to use instead of asking Slack for one (for testing)
+command_threads = config.getint('DEFAULT', 'command_threads') # number of chat commands (from different channels) handled at once
+slack_api_url = config.get('DEFAULT', 'slack_api_url') # where to send Slack Web API calls
+cache_renders = config.getboolean('DEFAULT', 'cache_renders') # keep rendered images on disk, or only ever in memory
+render_timeout_seconds = config.getfloat('DEFAULT', 'render_timeout_seconds') # give up on renders that take longer than this
+digest_mode = config.get('DEFAULT', 'digest_mode').strip().lower() # off, window or dawn
+digest_minutes = config.getfloat('DEFAULT', 'digest_minutes') # how long new reductions are collected for in window mode
+digest_max_panels = config.getint('DEFAULT', 'digest_max_panels') # most quicklooks in one montage
+show_max_targets = config.getint('DEFAULT', 'show_max_targets') # most targets in one "show me"
+encoding_profiles = encoding.read_profiles(config) # how images get encoded for each channel
+# rules for which files get posted. See path_classifier.default_rules
+path_rules = {}
+if config.has_section('path_rules'):
+    path_rules = dict((key, value) for key, value in config.items('path_rules', raw=True) if key in path_classifier.default_rules)
 
-# locks for plotting thread
-plotlock = Lock()
-notify_plotter = Condition(plotlock) # condition for the plotter to wait on
-notify_customers = Condition(plotlock) # condition for those waiting for plots to be produced to wait on
-plotqueue = queue.Queue() # first slot for NewImagePoster, second slot for ChatResponder
-completed_job_flag = [False, False, False] # Let's them know whose job has finished. 0 for NewImagerPoster, 1 for ChatRespodner. 
 
-class Plotter(Thread):
+def get_render_settings(channel):
     """
-    Because Matplotlib can only be called from a single python thread in a process..
+    How images get rendered for a channel. Everything that renders for a channel (or prewarms
+    for it) should use this, so they share render cache entries
 
-    Writes all images to tmp.png
+    Args:
+        channel: channel name or ID ("" for channels without settings of their own)
+    Return:
+        fast: True if the channel gets fast previews
+        dpi: resolution of full plots, from the channel's encoding profile
     """
-    def __init__(self):
-        """
-        Creates a plotter thread
-        """
-        super(Plotter, self).__init__()
-        self.daemon = True
-        self.nextindex = 0 # alternate between 0 and 1 so no one thread hogs the plotter
+    return channel.upper() in fast_preview_channels, encoding.get_profile(encoding_profiles, channel).dpi
+
+
+def get_fmmf_date(filepath):
+    """
+    FMMF quicklooks don't live in dated folders, so use the UT date they were made on
+
+    Args:
+        filepath: path to the quicklook
+    Return:
+        date: date as YYYYMMDD, or "" if the file isn't there
+    """
+    try:
+        return datetime.datetime.utcfromtimestamp(os.path.getmtime(filepath)).strftime("%Y%m%d")
+    except OSError:
+        return ""
 
-    def run(self):
-        global completed_job_flag
-        # infinite loop
-        while True:
-            with plotlock:
-                # wait for a job
-                while plotqueue.empty():
-                    notify_plotter.wait()
-                # I have a job
-                jobargs = plotqueue.get()
-                job_number = jobargs[0] # 0 for NewImagerPoster, 1 for ChatResponder
-                filepath = jobargs[1] # path to FITS file to be plotted
-                title = display_image.get_title_from_filename(filepath) # parser title from filepath
-                display_image.save_klcube_image(filepath, "tmp{0}.png".format(job_number), title=title) # plot iter
-
-                completed_job_flag[job_number] = True # set the completed job flag
-                notify_customers.notify_all()
 
 class NewImagePoster(FileSystemEventHandler):
     """
     Thread that posts new PSF subtracted images to the Slack Chat
     """
-    def __init__(self, dropboxdir, slacker_bot, bot_id, is_llp=False):
+    def __init__(self, dropboxdir, slack, render_service, dataset_index, reduction_catalog, stable_file_scheduler, durable_post_queue, post_rate_limiter, is_llp=False):
         """
         Runs on creation
         
         Args:
             dropboxdir: full path to dropboxdir to scan
-            slacker_bot: a Slacker instance
-            bot_id: a unique bot_id number to be used to index into the appropriate completed_job_flag
+            slack: a slack_gateway.SlackGateway to post with
+            render_service: a render.RenderService instance to make the images
+            dataset_index: the datasets.DatasetIndex of the tree we are monitoring. We keep it up to date
+            reduction_catalog: a catalog.ReductionCatalog. We add new reductions to it
+            stable_file_scheduler: a file_scheduler.StableFileScheduler to wait for new files to finish syncing
+            durable_post_queue: a post_queue.PostQueue to keep track of what needs posting and what has been posted
+            post_rate_limiter: a post_queue.RateLimiter shared by everything that posts automatically
             is_llp: if True, monitors disk LLP data instead
     
         """
         self.dropboxdir = dropboxdir
-        self.newfiles = []
-        self.newfmmffiles = []
-        self.lock = threading.Lock()
-        self.slacker = slacker_bot
-        self.job_number = bot_id # 0 for NewImagerPoster, 1 for ChatResponder, 2 for NewImagePoster-LLP
+        self.dataset_index = dataset_index
+        self.catalog = reduction_catalog
+        self.scheduler = stable_file_scheduler
+        self.post_queue = durable_post_queue
+        self.rate_limiter = post_rate_limiter
+        self.deferred = set() # kinds of posts waiting for the rate limit
+        self.deferred_lock = threading.Lock()
+        self.slack = slack
+        self.render_service = render_service
+        self.fmmf_discovery = fmmf.FMMFDiscovery() # remembers what the FMMF directories look like
+        self.classifier = path_classifier.PathClassifier(is_llp=is_llp, rules=path_rules) # what's worth posting
         self.is_llp = is_llp
+        # which of us the queued items belong to
+        if is_llp:
+            self.source = "llp"
+        else:
+            self.source = "campaign"
+        # in digest mode, new PSF subtractions get collected and posted together
+        if digest_mode in ("window", "dawn"):
+            self.digest = digest.Digest(self.post_digest, window_seconds=digest_minutes * 60., until_dawn=digest_mode == "dawn")
+        else:
+            self.digest = None
+
+    def resume(self):
+        """
+        Post anything left in the queue from before we restarted
+        """
+        self.drain("klip")
+        self.drain("fmmf")
         
     
-    def process_file(self):
-        global completed_job_flag
-        with self.lock:
-            if len(self.newfiles) == 0:
+    def file_ready(self, filepath):
+        """
+        A new PSF subtraction has finished syncing. Queue it up to be posted (unless we already 
+        have this exact file) and work through the queue
+
+        Args:
+            filepath: path to the KL mode cube
+        """
+        self.catalog.update(filepath, self.is_llp)
+        if self.post_queue.enqueue(self.source, "klip", filepath, obsdate=display_image.get_date_from_filename(filepath)):
+            print("appending {0}".format(filepath))
+        self.drain("klip")
+
+    def catalog_ready(self, filepath):
+        """
+        A reduction we don't post has finished syncing. Just add it to the catalog
+
+        Args:
+            filepath: path to the reduction
+        """
+        self.catalog.update(filepath, self.is_llp)
+
+    def fmmf_ready(self, filepath):
+        """
+        A FMMF quicklook or directory has finished syncing. Queue up the quicklook, or any new
+        quicklooks found in the directory (unless we already have these exact files), and work
+        through the queue
+
+        Args:
+            filepath: path to the quicklook or FMMF directory that changed
+        """
+        if os.path.isdir(filepath):
+            # rsync could have also synced a folder. Look for the syncing of the FMMF2018 directory
+            path_class = self.classifier.classify(filepath)
+            if path_class is None or path_class.kind != "fmmf_dir":
                 return
-            
-            filepath = self.newfiles.pop(0)
-            
+            print("promising folder. check for quicklook", filepath)
+            for ql_filepath in self.fmmf_discovery.find_new_quicklooks(filepath):
+                print("found one", ql_filepath)
+                # the queue makes sure we only post it once
+                self.post_queue.enqueue(self.source, "fmmf", ql_filepath, obsdate=get_fmmf_date(ql_filepath))
+        elif self.post_queue.enqueue(self.source, "fmmf", filepath, obsdate=get_fmmf_date(filepath)):
+            print("appending {0}".format(filepath))
+        self.drain("fmmf")
+
+    def drain(self, kind):
+        """
+        Post everything that's pending in the queue, tonight's data first. If we've posted too much
+        lately, the rest waits until we're allowed to post again. If there are too many old 
+        reductions waiting (e.g. someone synced an old campaign), they get rolled up into one post
+
+        Args:
+            kind: "klip" for PSF subtractions or "fmmf" for FMMF quicklooks
+        """
+        while True:
+            item = self.post_queue.claim(self.source, kind)
+            if item is None:
+                return
+            item_id, filepath, obsdate = item
+
+            # this claimed item plus every other old one still pending. Tonight's don't get rolled up, so they don't count
+            tonight = (datetime.datetime.utcnow() - datetime.timedelta(days=1)).strftime("%Y%m%d")
+            if obsdate < tonight and max_old_backlog > 0 and \
+                    self.post_queue.num_pending(self.source, kind, before_obsdate=tonight) + 1 >= max_old_backlog:
+                self.post_queue.release(item_id)
+                self.post_rollup(kind, self.post_queue.roll_up(self.source, kind, tonight))
+                continue
+            if kind == "fmmf" and os.path.isdir(filepath):
+                # queued by an older version of the bot, which queued FMMF directories too. Their
+                # quicklooks get queued on their own, so there's nothing to post (or count against the limit)
+                self.post_queue.finish(item_id, error="not a FMMF quicklook")
+                continue
+            if kind == "klip" and self.digest is not None:
+                # digests don't count against the rate limit. The item is finished once the digest is posted
+                try:
+                    self.add_to_digest(item_id, filepath)
+                except Exception as e:
+                    print("Couldn't add {0} to the digest: {1}".format(filepath, e))
+                    self.post_queue.finish(item_id, error=str(e))
+                continue
+            if not self.rate_limiter.try_acquire():
+                # come back to it once we're allowed to post again
+                self.post_queue.release(item_id)
+                self.defer(kind)
+                return
+
+            try:
+                if kind == "klip":
+                    self.process_file(filepath)
+                else:
+                    self.process_fmmf_event(filepath)
+            except Exception as e:
+                print("Couldn't post {0}: {1}".format(filepath, e))
+                self.post_queue.finish(item_id, error=str(e))
+            else:
+                self.post_queue.finish(item_id)
+
+    def defer(self, kind):
+        """
+        Try draining the queue again once the rate limit allows another post
+
+        Args:
+            kind: "klip" for PSF subtractions or "fmmf" for FMMF quicklooks
+        """
+        with self.deferred_lock:
+            if kind in self.deferred:
+                return
+            self.deferred.add(kind)
+        wait_time = self.rate_limiter.time_until_free()
+        print("Posted too much lately. Waiting {0:.0f} s to post more".format(wait_time))
+        timer = threading.Timer(wait_time, self._deferred_drain, [kind])
+        timer.daemon = True
+        timer.start()
+
+    def _deferred_drain(self, kind):
+        with self.deferred_lock:
+            self.deferred.discard(kind)
+        self.drain(kind)
+
+    def post_rollup(self, kind, filepaths):
+        """
+        Post one message about a bunch of old reductions instead of posting each one
+
+        Args:
+            kind: "klip" for PSF subtractions or "fmmf" for FMMF quicklooks
+            filepaths: paths of the reductions
+        """
+        if len(filepaths) == 0:
+            return
+        if kind == "klip":
+            channel = "#llp" if self.is_llp else "#gpies-observing"
+            titles = [display_image.get_title_from_filename(filepath) for filepath in filepaths]
+            what = "PSF subtractions"
+        else:
+            channel = "#gpies-data"
+            titles = [filepath.split(os.path.sep)[-1].split(".")[0] for filepath in filepaths]
+            what = "FMMF reductions"
+        max_titles = 10
+        listing = ", ".join(titles[:max_titles])
+        if len(titles) > max_titles:
+            listing += ", and {0} more".format(len(titles) - max_titles)
+        print("rolling up {0} {1}".format(len(filepaths), what))
+        print(self.slack.post_message(channel, "Beep. Boop. {0} older {1} just showed up, which is too many to post one at a time: {2}. Ask me to show you any of them.".format(len(titles), what, listing), username=username).result())
+
+    def process_file(self, filepath):
+        """
+        Post a new PSF subtraction. Raises an exception if it couldn't
+
+        Args:
+            filepath: path to the KL mode cube
+        """
         # get title and make image after getting new klip file
         title = display_image.get_title_from_filename(filepath)
         #display_image.save_klcube_image(filepath, "tmp.png", title=title)
-        #print(self.slacker.chat.post_message('@jwang', 'Beep. Boop. {0}'.format(filepath), username=username, as_user=True).raw)
-
-        # send job to plotter to get plotted
-        with plotlock:
-            # construct the job arguments
-            job_args = (self.job_number, filepath)
-            plotqueue.put(job_args)
-            completed_job_flag[self.job_number] = False
-            # ask the plotter to do its job
-            notify_plotter.notify()
-            # wait for job to finish
-            while not completed_job_flag[self.job_number]:
-                notify_customers.wait()
-            # horray job is finished!
-        
+
         if self.is_llp:
             channel = "#llp"
         else:
             channel = "#gpies-observing"
 
-        print(self.slacker.chat.post_message(channel, "Beep. Boop. I just finished a PSF Subtraction for {0}. Here's a quicklook image.".format(title), username=username, as_user=True).raw)
-        print(self.slacker.files.upload('tmp{0}.png'.format(self.job_number), channels=channel,filename="{0}.png".format(title.replace(" ", "_")), title=title ).raw)
+        # send job to the render service and wait for it to get plotted
+        profile = encoding.get_profile(encoding_profiles, channel)
+        fast, dpi = get_render_settings(channel)
+        png_data = self.render_service.render(filepath, fast=fast, priority=render.AUTOMATIC, dpi=dpi).result()
+        image_data, extension = encoding.encode_image(png_data, profile, label=title)
+
+        print(self.slack.post_message(channel, "Beep. Boop. I just finished a PSF Subtraction for {0}. Here's a quicklook image.".format(title), username=username).result())
+        print(self.slack.upload_file(image_data, channel, "{0}.{1}".format(title.replace(" ", "_"), extension), title).result())
+
+        # now that it's posted, get the images people will probably ask for next into the render cache
+        self.prewarm_likely_requests(filepath)
         return
-    
-    def process_fmmf_event(self):
+
+    def prewarm_likely_requests(self, filepath):
         """
-        Handles a FMMF event specifically. Different from rest of Data Cruncher
+        Get the images people will probably ask for after seeing a new PSF subtraction into the
+        render cache
+
+        Args:
+            filepath: path to the new KL mode cube
         """
-        with self.lock:
-            if len(self.newfmmffiles) == 0:
-                return
-            
-            filepath = self.newfmmffiles.pop(0)
- 
-        new_ql = False
-        if filepath.endswith("_allquicklooks.png"):
-            new_ql = True
-            ql_filepath = filepath
-        else:
-            # rsync could have also synced a folder. check for that
-            if os.path.isdir(filepath):
-                # look for the syncing of the FMMF2018 directory
-                matches = re.findall(r".*FMMF20[0-9]{2}$", filepath)
-                if len(matches) == 0:
-                    return
+        # what the channels that could ask will request: the one we post to, the ones with settings
+        # of their own, and everywhere else
+        channels = set(["#llp" if self.is_llp else "#gpies-observing", ""] + fast_preview_channels + list(encoding_profiles.keys()))
+        render_settings = set(get_render_settings(channel) for channel in channels)
+        for likely_filepath in self.dataset_index.get_likely_requests(filepath):
+            for fast, dpi in render_settings:
+                self.render_service.prewarm(likely_filepath, fast=fast, dpi=dpi)
 
-                print("promising folder. check for quicklook", filepath)
-                for rootdir, subdirs, files in os.walk(filepath):
-                    for fmmf_file in files:
-                        if fmmf_file.endswith("_allquicklooks.png"):
-                            print("found one", rootdir, fmmf_file)
-                            # might be a new ql. check date modified
-                            dirtime = os.path.getmtime(filepath)
-                            qltime = os.path.getmtime(os.path.join(rootdir, fmmf_file))
-                            deltat = abs(dirtime - qltime)/3600 #in horus
-                            if deltat <= 24: # within a day of each other
-                                print("delta_t", deltat)
-                                new_ql = True
-                                ql_filepath = os.path.join(rootdir, fmmf_file)
-        
-        if new_ql:
-            # post it
-            channel = "#gpies-data"
-            title = ql_filepath.split(os.path.sep)[-1].split(".")[0] # strip the filepath and the file extension
-            print(self.slacker.chat.post_message(channel, "Beep. Boop. I just finished a FMMF reduction for {0}. Here's the quicklook.".format(title), username=username, as_user=True).raw)
-            print(self.slacker.files.upload(ql_filepath, channels=channel, filename=ql_filepath.split(os.path.sep)[-1], title=title ).raw)
+    def add_to_digest(self, item_id, filepath):
+        """
+        Plot a new PSF subtraction and save it for the next digest. Raises an exception if it
+        couldn't be plotted
+
+        Args:
+            item_id: its post queue item, finished once the digest is posted
+            filepath: path to the KL mode cube
+        """
+        title = display_image.get_title_from_filename(filepath)
+        channel = "#llp" if self.is_llp else "#gpies-observing"
+        profile = encoding.get_profile(encoding_profiles, channel)
+        fast, dpi = get_render_settings(channel)
+        png_data = self.render_service.render(filepath, fast=fast, priority=render.AUTOMATIC, dpi=dpi).result()
+        print("adding {0} to the digest".format(title))
+        self.digest.add((item_id, title, png_data))
+        self.prewarm_likely_requests(filepath)
+
+    def post_digest(self, entries):
+        """
+        Post a digest of new PSF subtractions: one message listing all of them, and montages of
+        their quicklooks. Runs on the digest's timer
+
+        Args:
+            entries: list of (post queue item ID, title, PNG data)
+        """
+        channel = "#llp" if self.is_llp else "#gpies-observing"
+        profile = encoding.get_profile(encoding_profiles, channel)
+        titles = [title for item_id, title, png_data in entries]
+        panels_per_montage = max(1, digest_max_panels)
+        stamp = datetime.datetime.utcnow().strftime("%Y%m%d_%H%M")
+        try:
+            # make all the montages first, so nothing gets posted if one can't be made
+            uploads = []
+            for start in range(0, len(entries), panels_per_montage):
+                chunk = entries[start:start + panels_per_montage]
+                montage = digest.make_montage([digest.decode_png(png_data) for item_id, title, png_data in chunk])
+                montage_title = "; ".join(title for item_id, title, png_data in chunk)
+                image_data, extension = encoding.encode_image(display_image.encode_png(montage), profile, label="digest")
+                uploads.append((image_data, "digest_{0}_{1}.{2}".format(stamp, len(uploads) + 1, extension), montage_title))
+
+            print("posting a digest of {0} PSF subtractions".format(len(entries)))
+            print(self.slack.post_message(channel, "Beep. Boop. I finished {0} PSF subtraction{1}: {2}. {3} of the quicklooks.".format(
+                    len(titles), "" if len(titles) == 1 else "s", ", ".join(titles), "Here's a montage" if len(uploads) == 1 else "Here are montages"),
+                    username=username).result())
+            for image_data, filename, montage_title in uploads:
+                print(self.slack.upload_file(image_data, channel, filename, montage_title).result())
+        except Exception as e:
+            print("Couldn't post the digest: {0}".format(e))
+            for item_id, title, png_data in entries:
+                self.post_queue.finish(item_id, error=str(e))
+            return
+        for item_id, title, png_data in entries:
+            self.post_queue.finish(item_id)
+    
+    def process_fmmf_event(self, filepath):
+        """
+        Post a FMMF quicklook. Different from rest of Data Cruncher. Raises an exception if it couldn't
+
+        Args:
+            filepath: path to the quicklook
+        """
+        ql_filepath = filepath
+        channel = "#gpies-data"
+        title = ql_filepath.split(os.path.sep)[-1].split(".")[0] # strip the filepath and the file extension
+        print(self.slack.post_message(channel, "Beep. Boop. I just finished a FMMF reduction for {0}. Here's the quicklook.".format(title), username=username).result())
+        with open(ql_filepath, "rb") as ql_file:
+            image_data, extension = encoding.encode_image(ql_file.read(), encoding.get_profile(encoding_profiles, channel), label=title)
+        print(self.slack.upload_file(image_data, channel, "{0}.{1}".format(title, extension), title).result())
 
     
     def process_new_file_event(self, filepath):
@@ -185,43 +440,22 @@ class NewImagePoster(FileSystemEventHandler):
         Args:
             filepath: path to file that was changed
         """
-        
-        # we are looking for the first PSF subtraction that happens
-        if "_Pol" in filepath:
-            # for pol, doens't matter if campaign or LLP
-            matches = re.findall(r".*m1-(ADI-)?KLmodes-all\.fits", filepath)
-        elif "autoreduced_kpop" in filepath:
-            if "Non-Campaign" in filepath:
-                # don't post queue stuff for FMMF
-                return
-            print(filepath)
-            # add item to queue
-            with self.lock:
-                if filepath not in self.newfmmffiles:
-                    print("appending {0}".format(filepath))
-                    self.newfmmffiles.append(filepath)
-            # wait 3 seconds before processing
-            threading.Timer(3., self.process_fmmf_event).start() 
+        path_class = self.classifier.classify(filepath)
+        if path_class is None:
+            # not something we post, but it might go in the catalog once it's done syncing
+            if catalog.is_reduction_path(filepath):
+                self.scheduler.schedule(filepath, self.catalog_ready, is_complete=display_image.is_fits_complete)
             return
-        else: 
-            # spec mode
-            if self.is_llp:
-                matches = re.findall(r".*m1-(nohp-)?(ADI-)?KLmodes-all\.fits", filepath)
-            else:
-                # just regular campaign
-                matches = re.findall(r".*m1-KLmodes-all\.fits", filepath)
-        # not a PSF subtraction
-        if len(matches) <= 0:
-            return
-            
-        # add item to queue
-        with self.lock:
-            if filepath not in self.newfiles:
-                print("appending {0}".format(filepath))
-                self.newfiles.append(filepath)
-
-        # wait 3 seconds before processing
-        threading.Timer(3., self.process_file).start() 
+
+        # queue it up once it's done syncing
+        if path_class.kind == "klip":
+            self.scheduler.schedule(filepath, self.file_ready, is_complete=display_image.is_fits_complete)
+        elif path_class.kind == "fmmf_quicklook":
+            print(filepath)
+            self.scheduler.schedule(filepath, self.fmmf_ready, is_complete=display_image.is_png_complete)
+        else:
+            print(filepath)
+            self.scheduler.schedule(filepath, self.fmmf_ready)
         
         
     def on_created(self, event):
@@ -229,6 +463,7 @@ class NewImagePoster(FileSystemEventHandler):
         """
         watchdog function to run when a new file appears
         """
+        self.dataset_index.add_path(event.src_path)
         self.process_new_file_event(event.src_path)
 
         
@@ -236,6 +471,7 @@ class NewImagePoster(FileSystemEventHandler):
         """
         watchdog function to run when an existing file is modified
         """
+        self.dataset_index.add_path(event.src_path)
         self.process_new_file_event(event.src_path)
 
     def on_moved(self, event):
@@ -243,25 +479,43 @@ class NewImagePoster(FileSystemEventHandler):
         watchdog fucntion to run when a file is moved. We care about where it moved to
         """
         print("move", event.src_path, event.dest_path)
+        self.dataset_index.remove_path(event.src_path)
+        self.dataset_index.add_path(event.dest_path)
+        self.catalog.remove(event.src_path)
         self.process_new_file_event(event.dest_path)
+
+    def on_deleted(self, event):
+        """
+        watchdog function to run when a file is deleted. Just need to forget about it
+        """
+        self.dataset_index.remove_path(event.src_path)
+        self.catalog.remove(event.src_path)
     
 
 class ChatResponder(Thread):
-    def __init__(self, dropboxdir, slack_bot, slacker):
+    def __init__(self, dropboxdir, slack_bot, slack, render_service, dataset_index, llp_dataset_index, reduction_catalog):
         """
         Init
         
         Args:
             dropboxdir: absolute dropbox path
-            slack_bot: a SlackClient instance
-            slacker: a Slacker instance
+            slack_bot: a SlackClient instance, just for connecting to RTM
+            slack: a slack_gateway.SlackGateway to post with
+            render_service: a render.RenderService instance to make the images
+            dataset_index: datasets.DatasetIndex of GPIDATA
+            llp_dataset_index: datasets.DatasetIndex of GPIDATA-LLP
+            reduction_catalog: a catalog.ReductionCatalog to look up reductions by metadata
         """
         super(ChatResponder, self).__init__()
         self.dropboxdir = dropboxdir
+        self.dataset_index = dataset_index
+        self.llp_dataset_index = llp_dataset_index
+        self.catalog = reduction_catalog
         self.slack_client = slack_bot
-        self.slacker = slacker
-
-        self.job_number = 1 # 0 for NewImagerPoster, 1 for ChatResponder
+        self.slack = slack
+        self.render_service = render_service
+        # commands run in the background, in order within each channel
+        self.dispatcher = dispatch.CommandDispatcher(workers=command_threads, slow_workers=command_threads)
 
         self.llp_channel = 'C2N6953GP'
 
@@ -274,81 +528,15 @@ class ChatResponder(Thread):
                     
                     
     def run(self):
-        connected = self.slack_client.rtm_connect()
-        if not connected:
-            print("Connection Failed, invalid token?")
-            return
-
-        while connected:
-            try:
-                events = self.slack_client.rtm_read()
-            #except (WebSocketConnectionClosedException, socket.timeout):
-            except:
-                #couldn't connect. Try to reconnect...
-                connected = self.slack_client.rtm_connect()
-                continue
-
-            for event in events:
-                self.parse_event(event)
-                        
-            time.sleep(1)
+        if len(rtm_url) > 0:
+            get_url = lambda: rtm_url
         else:
-            print("Connection Failed, invalid token?")
+            get_url = lambda: rtm.get_slack_rtm_url(self.slack_client)
+        # events get handled as soon as they come in
+        receiver = rtm.RTMReceiver(get_url, self.parse_event)
+        receiver.run_forever()
     
 
-    def choose_folder(self, folders, date=None, band=None, mode=None):
-        """
-        Given subfolders in an autoreduced directory and some optional specifications,
-        find the best dataset to show
-
-        Args:
-            folders: a list of folders 
-            date: datestring (e.g 20141212)
-            band: e.g. H
-            mode Spec or Pol
-        Return:
-            chosen: chosen folder Name. None is nothing is chosen
-        """
-        # boudnary case of no folders
-        if len(folders) == 0:
-            return None
-
-        # limit by date
-        if date is not None:
-            folders = [folder for folder in folders if "{0}_".format(date) in folder]
-
-        # limit by band
-        if band is not None:
-            folders = [folder for folder in folders if "_{0}_".format(band) in folder]
-
-        # limit by mode
-        if mode is not None:
-            folders = [folder for folder in folders if "_{0}".format(mode) in folder]
-
-        # if more than one, pick a spec dataset in H band preferably. If not, just pick the first
-        if len(folders) > 1:
-            # narrow by spec if Pol not specified
-            if mode is None:
-                spec_folders = [folder for folder in folders if "_{0}".format("Spec") in folder]
-                # if there are spec datsets, let's pick those
-                if len(spec_folders) > 0:
-                    folders = spec_folders
-            # narrow by H band if not specified
-            if band is None:
-                H_folders = [folder for folder in folders if "_{0}_".format("H") in folder]
-                # if there are H datasets, pick those
-                if len(H_folders) > 0:
-                    folders = H_folders
-
-        # now pick the first one if we haven't removed all choices
-        if len(folders) > 0:
-            chosen = folders[0]
-        else:
-            chosen = None
-        return chosen
-
-
-
     def get_klipped_img_info(self, request, is_llp):
         """
         Get the info for a Klipped image that was requested
@@ -366,7 +554,7 @@ class ChatResponder(Thread):
         """
         request_args = request.split(',')
         
-        objname = request_args[0].strip().replace(" ", "_")
+        objname = self.resolve_objname(request_args[0], is_llp)
    
         date, band, mode = None, None, None
         if len(request_args) > 1:
@@ -378,51 +566,107 @@ class ChatResponder(Thread):
 
         # configure whether LLP data or not
         if is_llp:
-            GPIDATA_str = "GPIDATA-LLP"
+            dataset_index = self.llp_dataset_index
         else:
-            GPIDATA_str = "GPIDATA"
-        # get object name dropbox path
-        auto_dirpath = os.path.join(self.dropboxdir, GPIDATA_str, objname, "autoreduced")
-        print(auto_dirpath)
-        # make sure folder exists
-        if not os.path.isdir(auto_dirpath):
-            return None
-       
-        date_folders = [fname for fname in os.listdir(auto_dirpath) if os.path.isdir(os.path.join(auto_dirpath, fname))]
-        if len(date_folders) == 0:
-            # no subdirs, uh oh
-            return None
+            dataset_index = self.dataset_index
 
-        datefolder = self.choose_folder(date_folders, date=date, band=band, mode=mode)
-        if datefolder is None:
-            # couldn't find it
-            return None
-        
+        return dataset_index.find_klipped_img(objname, date=date, band=band, mode=mode)
 
-        dateband = datefolder.split("_")
-        date = dateband[0]
-        band = dateband[1]
-        mode = dateband[2]
- 
-        dirpath = os.path.join(auto_dirpath,  "{0}_{1}_{2}".format(date, band, mode))
-        if mode == "Spec":
-            # in Spec, LLP has a different reduction set
-            if is_llp:
-                pyklip_name = "pyklip-S{date}-{band}-k50a9s1m1-nohp-ADI-KLmodes-all.fits"
+    def resolve_objname(self, name, is_llp):
+        """
+        Figure out the object directory name for an object name someone typed. Doesn't care about 
+        case, spaces, underscores or how the catalog is written (e.g. "hr8799" gives "HR_8799")
+
+        Args:
+            name: object name as typed
+            is_llp: if we are looking for LLP data
+        Return:
+            objname: object directory name. If nothing matches, just the name with underscores for spaces
+        """
+        # configure whether LLP data or not
+        if is_llp:
+            dataset_index = self.llp_dataset_index
+        else:
+            dataset_index = self.dataset_index
+
+        objname, suggestions = dataset_index.resolve_name(name)
+        if objname is None:
+            objname = name.strip().replace(" ", "_")
+        return objname
+
+    def get_name_suggestions(self, request, is_llp):
+        """
+        Get some "did you mean" object names for a request we couldn't find
+
+        Args:
+            request: the request (object name is the first thing before any commas)
+            is_llp: if we are looking for LLP data
+        Return:
+            suggestions: list of object names (with spaces). Empty if nothing is close
+        """
+        # configure whether LLP data or not
+        if is_llp:
+            dataset_index = self.llp_dataset_index
+        else:
+            dataset_index = self.dataset_index
+
+        objname, suggestions = dataset_index.resolve_name(request.split(',')[0])
+        return [suggestion.replace("_", " ") for suggestion in suggestions]
+
+    def get_latest_img_info(self, request, is_llp):
+        """
+        Get the info for the newest Klipped image that matches a request
+
+        Args:
+            request: a string in the form of "[Band] [Mode][ of Object Name]" (e.g. "H", "Pol of HR 8799")
+            is_llp: if we are looking for LLP data
+
+        Returns:
+            filename: the full path to the klipped image
+            objname: object name (with spaces)
+            date: with dashes
+            band: the band
+            mode: obsmode
+        """
+        objname, band, mode = None, None, None
+        request_args = re.split(r"\s+of\s+", request.strip(), maxsplit=1, flags=re.IGNORECASE)
+        if len(request_args) > 1:
+            objname = self.resolve_objname(request_args[1], is_llp)
+        for spec in request_args[0].split():
+            if spec.upper() in ("SPEC", "POL"):
+                mode = spec.capitalize()
             else:
-                # new pyklip reductions
-                pyklip_name = "pyklip-S{date}-{band}-k300a9s4m1-KLmodes-all.fits"
-                # if they don't exist for this dataset, default to old ones
-                if not os.path.exists(os.path.join(dirpath, pyklip_name.format(date=date, band=band))):
-                    pyklip_name = "pyklip-S{date}-{band}-k150a9s4m1-KLmodes-all.fits"
-                    
+                band = spec.upper()
+
+        newest = self.catalog.find_latest(is_llp, objname=objname, band=band, mode=mode)
+        if newest is None:
+            return None
+        objname, date, band, mode = newest
+
+        # configure whether LLP data or not
+        if is_llp:
+            dataset_index = self.llp_dataset_index
         else:
-            pyklip_name = "pyklip-S{date}-{band}-pol-k100a9s1m1-ADI-KLmodes-all.fits"
-    
-        pyklip_name = pyklip_name.format(date=date, band=band)
-        
-        filename = os.path.join(dirpath, pyklip_name)
-        return filename, objname.replace("_", " "), date, band, mode
+            dataset_index = self.dataset_index
+
+        return dataset_index.find_klipped_img(objname, date=date, band=band, mode=mode)
+
+    def find_requested_img(self, request, is_llp):
+        """
+        Look up the Klipped image for one "show me" request
+
+        Args:
+            request: "Object Name[, Date[, Band[, Mode]]]" or "latest [Band] [Mode][ of Object Name]"
+            is_llp: if we are looking for LLP data
+        Return:
+            klip_info: (filename, objname, date, band, mode) like get_klipped_img_info, or None if not found
+            suggestions: "did you mean" object names if it wasn't found
+        """
+        if request.upper()[:6] in ("LATEST", "NEWEST"):
+            return self.get_latest_img_info(request[6:], is_llp), []
+        klip_info = self.get_klipped_img_info(request, is_llp)
+        suggestions = self.get_name_suggestions(request, is_llp) if klip_info is None else []
+        return klip_info, suggestions
 
     def get_joke(self):
         """
@@ -447,6 +691,142 @@ class ChatResponder(Thread):
         else:
             return "*[screechy modem noises]*"
         
+    def post_message(self, channel, text):
+        """
+        Post a message and wait for it to go out, so replies in a channel stay in order
+
+        Args:
+            channel: channel ID
+            text: message
+        """
+        try:
+            print(self.slack.post_message(channel, text, username=username).result())
+        except slack_gateway.SlackError as e:
+            print("Couldn't post to {0}: {1}".format(channel, e))
+
+    def get_command_type(self, msg):
+        """
+        Figure out which command a message is
+
+        Args:
+            msg: text someone sent to the data cruncher (without the @data_cruncher)
+        Return:
+            command_type: "show", "joke", "time", "sunrise", "sunset", "moon", "cache stats", 
+                          "command stats", "help", or "chat" for anything else
+        """
+        msg = msg.strip().upper()
+        if msg[:4] == "SHOW":
+            return "show"
+        elif msg[:4] == "TELL" and "JOKE" in msg:
+            return "joke"
+        elif msg[:4] == "TIME":
+            return "time"
+        elif "SUNRISE" in msg:
+            return "sunrise"
+        elif "SUNSET" in msg:
+            return "sunset"
+        elif "MOON" == msg or "MOON PHASE" in msg:
+            return "moon"
+        elif "CACHE STATS" in msg:
+            return "cache stats"
+        elif "COMMAND STATS" in msg:
+            return "command stats"
+        elif "HELP" == msg:
+            return "help"
+        return "chat"
+
+    def upload_render(self, render_future, pyklip_filename, sender, channel):
+        """
+        Upload an image someone asked for once it's been plotted (or say sorry if it couldn't be)
+
+        Args:
+            render_future: the future from the render service
+            pyklip_filename: the KL mode cube that was plotted
+            sender: ID of who asked
+            channel: ID of channel
+        """
+        title = display_image.get_title_from_filename(pyklip_filename)
+        try:
+            png_data = render_future.result()
+        except Exception as e:
+            print("Couldn't make a quicklook for {0}: {1}".format(pyklip_filename, e))
+            full_reply = '<@{user}>: '.format(user=sender) + self.beepboop()+" I'm sorry, but I couldn't plot the data you requested"
+            self.post_message(channel, full_reply)
+            return
+        image_data, extension = encoding.encode_image(png_data, encoding.get_profile(encoding_profiles, channel), label=title)
+        self.slack.upload_file(image_data, channel, "{0}.{1}".format(title.replace(" ", "_"), extension), title).add_done_callback(slack_gateway.print_result)
+
+    def show_several(self, requests, is_llp, sender, channel):
+        """
+        Answer a "show me" for several targets: look them all up, render them all at once, and
+        upload one montage when the last one is done
+
+        Args:
+            requests: list of requests, each like the ones find_requested_img takes
+            is_llp: if we are looking for LLP data
+            sender: ID of who asked
+            channel: ID of channel
+        """
+        skipped = requests[show_max_targets:]
+        found = []
+        missing = []
+        for request in requests[:show_max_targets]:
+            klip_info, suggestions = self.find_requested_img(request, is_llp)
+            if klip_info is None:
+                if len(suggestions) > 0:
+                    request += " (did you mean {0}?)".format(" or ".join(suggestions))
+                missing.append(request)
+            elif klip_info[0] not in [found_info[0] for found_info in found]:
+                found.append(klip_info)
+
+        reply = self.beepboop()
+        if len(found) > 0:
+            reply += " Retrieving " + ", ".join('{obj} taken on {date} in {band}-{mode}'.format(obj=objname, date=date, band=band, mode=mode)
+                                                for pyklip_filename, objname, date, band, mode in found) + "..."
+        if len(missing) > 0:
+            reply += " I'm sorry, but I couldn't find {0}.".format("; ".join(missing))
+        if len(skipped) > 0:
+            reply += " I can only show {0} at a time, so I skipped {1}.".format(show_max_targets, "; ".join(skipped))
+        full_reply = '<@{user}>: '.format(user=sender) + reply
+        self.post_message(channel, full_reply)
+        if len(found) == 0:
+            return
+
+        # the render pool works on all of them at once, so this takes about as long as the slowest one
+        pyklip_filenames = [klip_info[0] for klip_info in found]
+        fast, dpi = get_render_settings(channel)
+        render_futures = [self.render_service.render(pyklip_filename, fast=fast, dpi=dpi) for pyklip_filename in pyklip_filenames]
+        self.dispatcher.submit_slow_when_done(render_futures, "show montage", self.upload_montage, render_futures, pyklip_filenames, sender, channel)
+
+    def upload_montage(self, render_futures, pyklip_filenames, sender, channel):
+        """
+        Upload a montage of images someone asked for, with a caption on each, once they've all been
+        plotted. Say sorry for any that couldn't be
+
+        Args:
+            render_futures: the futures from the render service, all done
+            pyklip_filenames: the KL mode cubes that were plotted, in the same order
+            sender: ID of who asked
+            channel: ID of channel
+        """
+        images, captions, failed = [], [], []
+        for render_future, pyklip_filename in zip(render_futures, pyklip_filenames):
+            title = display_image.get_title_from_filename(pyklip_filename)
+            try:
+                images.append(digest.decode_png(render_future.result()))
+                captions.append(title)
+            except Exception as e:
+                print("Couldn't make a quicklook for {0}: {1}".format(pyklip_filename, e))
+                failed.append(title)
+        if len(failed) > 0:
+            full_reply = '<@{user}>: '.format(user=sender) + self.beepboop()+" I'm sorry, but I couldn't plot {0}".format(", ".join(failed))
+            self.post_message(channel, full_reply)
+        if len(images) == 0:
+            return
+        montage = digest.make_montage(images, captions=captions)
+        image_data, extension = encoding.encode_image(display_image.encode_png(montage), encoding.get_profile(encoding_profiles, channel), label="montage")
+        self.slack.upload_file(image_data, channel, "montage_of_{0}.{1}".format(len(images), extension), "; ".join(captions)).add_done_callback(slack_gateway.print_result)
+
     def craft_response(self, msg, sender, channel):
         """
         Given some input text from someone, craft this a response
@@ -459,12 +839,12 @@ class ChatResponder(Thread):
         Return:
             
         """
-        global completed_job_flag
         if msg is None:
             return
                
         msg = msg.strip()
-        if (msg.upper()[:4] == "SHOW") | (msg.upper()[:7] == "SHOW ME"):
+        command_type = self.get_command_type(msg)
+        if command_type == "show":
             # Someone wants us to show them something!!
             # strip off the "Show (me)?"
             if "SHOW ME" in msg.upper():
@@ -476,45 +856,39 @@ class ChatResponder(Thread):
             # get requested pyklip reduction by parsing message
             # check if LLP
             is_llp_data = channel.upper() == self.llp_channel.upper()
-            klip_info = self.get_klipped_img_info(msg, is_llp_data)
+            # several targets can be asked for at once, separated by semicolons
+            requests = [request.strip() for request in msg.split(";") if len(request.strip()) > 0]
+            if len(requests) > 1:
+                self.show_several(requests, is_llp_data, sender, channel)
+                return
+            if len(requests) == 1:
+                msg = requests[0]
+            klip_info, suggestions = self.find_requested_img(msg, is_llp_data)
             if klip_info is None:
                 reply = self.beepboop()+" I'm sorry, but I couldn't find the data you requested"
+                if len(suggestions) > 0:
+                    reply += ". Did you mean {0}?".format(" or ".join(suggestions))
             else:
                 # found it. Let's get the details of the request
                 pyklip_filename, objname, date, band, mode = klip_info
                 
                 reply = self.beepboop()+' Retrieving {obj} taken on {date} in {band}-{mode}...'.format(obj=objname, date=date, band=band, mode=mode)
                 
-                # generate image to upload
-                title = display_image.get_title_from_filename(pyklip_filename)
-                # display_image.save_klcube_image(pyklip_filename, "tmp.png", title=title)
-                
-                # send job to plotter to get plotted
-                with plotlock:
-                    # construct the job arguments
-                    job_args = (self.job_number, pyklip_filename)
-                    plotqueue.put(job_args)
-                    completed_job_flag[self.job_number] = False
-                    # ask the plotter to do its job
-                    notify_plotter.notify()
-                    # wait for job to finish
-                    while not completed_job_flag[self.job_number]:
-                        notify_customers.wait()
-                    # horray job is finished!
-                
-            # generate and send reply
+            # generate and send reply right away, the image can follow
             full_reply = '<@{user}>: '.format(user=sender) + reply
-            print(self.slack_client.api_call("chat.postMessage", channel=channel, text=full_reply, username=username, as_user=True))
-            # upload image
+            self.post_message(channel, full_reply)
             if klip_info is not None:
-                print(self.slacker.files.upload('tmp{0}.png'.format(self.job_number), channels=channel,filename="{0}.png".format(title.replace(" ", "_")), title=title ).raw)
-        elif (msg.upper()[:4] == "TELL") and ("JOKE" in msg.upper()):
+                # send job to the render service, and upload it once it's plotted without holding up the channel
+                fast, dpi = get_render_settings(channel)
+                render_future = self.render_service.render(pyklip_filename, fast=fast, dpi=dpi)
+                render_future.add_done_callback(lambda future: self.dispatcher.submit_slow("show upload", self.upload_render, future, pyklip_filename, sender, channel))
+        elif command_type == "joke":
             joke = self.get_joke()
             if joke is not None:
                 full_reply = '<@{user}>: '.format(user=sender) + joke
-                print(self.slack_client.api_call("chat.postMessage", channel=channel, text=full_reply, username=username, as_user=True))
+                self.post_message(channel, full_reply)
  
-        elif (msg.upper()[:4] == 'TIME'):
+        elif command_type == "time":
             thistz = msg[4:].strip().upper()
             curr_time = timezone.get_time_now(thistz)
             if curr_time is not None:
@@ -522,35 +896,55 @@ class ChatResponder(Thread):
             else:
                 time_reply = "{tz} is not a valid time zone".format(tz=thistz)
             full_reply = '<@{user}>: '.format(user=sender) + time_reply
-            print(self.slack_client.api_call("chat.postMessage", channel=channel, text=full_reply, username=username, as_user=True))
-        elif 'SUNRISE' in msg.upper():
+            self.post_message(channel, full_reply)
+        elif command_type == "sunrise":
             time_reply = suntimes.sunrise_time_response()
             full_reply = '<@{user}>: '.format(user=sender) + time_reply
-            print(self.slack_client.api_call("chat.postMessage", channel=channel, text=full_reply, username=username, as_user=True))
-        elif 'SUNSET' in msg.upper():
+            self.post_message(channel, full_reply)
+        elif command_type == "sunset":
             time_reply = suntimes.sunset_time_response()
             full_reply = '<@{user}>: '.format(user=sender) + time_reply
-            print(self.slack_client.api_call("chat.postMessage", channel=channel, text=full_reply, username=username, as_user=True))
-        elif 'MOON' == msg.upper() or 'MOON PHASE' in msg.upper():
+            self.post_message(channel, full_reply)
+        elif command_type == "moon":
             moon_phase = suntimes.get_current_moon_phase()
             full_reply = '<@{user}>: '.format(user=sender) + moon_phase
-            print(self.slack_client.api_call("chat.postMessage", channel=channel, text=full_reply, username=username, as_user=True))
-        elif 'HELP' == msg.upper():
+            self.post_message(channel, full_reply)
+        elif command_type == "cache stats":
+            stats = self.render_service.render_cache.stats()
+            cache_reply = "My render cache has had {hits} hits and {misses} misses, and is using {used:.1f} of {budget:.1f} MB".format(
+                            hits=stats["hits"], misses=stats["misses"], used=stats["bytes"]/1024.**2, budget=stats["max_bytes"]/1024.**2)
+            full_reply = '<@{user}>: '.format(user=sender) + cache_reply
+            self.post_message(channel, full_reply)
+        elif command_type == "command stats":
+            stats = self.dispatcher.stats()
+            stats_reply = "Here's how long commands have waited and taken (mean/max, in seconds):"
+            for stats_type in sorted(stats):
+                type_stats = stats[stats_type]
+                stats_reply += "\n{0}: {1} run, waited {2:.2f}/{3:.2f}, took {4:.2f}/{5:.2f}".format(
+                                stats_type, type_stats["count"], type_stats["mean_wait"], type_stats["max_wait"],
+                                type_stats["mean_run"], type_stats["max_run"])
+            full_reply = '<@{user}>: '.format(user=sender) + stats_reply
+            self.post_message(channel, full_reply)
+        elif command_type == "help":
             help_msg = (self.beepboop()+" I am smart enough to respond to these queries:\n"
                        "1. show me objectname[, datestring[, band[, mode]]] (e.g. show me c Eri, 20141218, H, Spec)\n"
+                       "   or show me latest [band] [mode][ of objectname] (e.g. show me latest H, show me newest Pol of HR 8799)\n"
+                       "   or several at once, separated by semicolons (e.g. show me HR 8799; 51 Eri, 20141218; latest K1)\n"
                        "2. time [timezone, LST, UTC] (e.g. time CLT)\n"
                        "3. sun[set/rise] (for the next sunset or sunrise time)\n"
                        "4. moon phase (for the current moon phase)\n"
                        "5. tell me a joke\n"
+                       "6. cache stats (how well my render cache is doing)\n"
+                       "7. command stats (how quickly I've been answering)\n"
                        "I also will post new PSF subtractions as I process them. " 
                        "Just please don't say anything too complicated because I'm not that smart. Yet. :)")
             full_reply = '<@{user}>: '.format(user=sender) + help_msg
-            print(self.slack_client.api_call("chat.postMessage", channel=channel, text=full_reply, username=username, as_user=True)) 
+            self.post_message(channel, full_reply) 
             
         else:
             reply = self.sarcastic_response(msg)
             full_reply = '<@{user}>: '.format(user=sender) + reply
-            print(self.slack_client.api_call("chat.postMessage", channel=channel, text=full_reply, username=username, as_user=True))    
+            self.post_message(channel, full_reply)    
                         
             
     def sarcastic_response(self, msg):        
@@ -657,51 +1051,103 @@ class ChatResponder(Thread):
 
             print(u"From {0}@{1}".format(sender, channel))
             msg_parsed = self.parse_txt(msg)
-            try:
-                self.craft_response(msg_parsed, sender, channel)
-            except IndexError:
-                # woops, message was too short we index errored
+            if msg_parsed is None:
                 return
+            # answer in the background, so nobody waits on anyone else's command
+            self.dispatcher.submit(channel, self.get_command_type(msg_parsed), self.respond, msg_parsed, sender, channel)
+
+    def respond(self, msg, sender, channel):
+        """
+        Reply to a message. Runs on the dispatcher
+
+        Args:
+            msg: text someone sent to the data cruncher (without the @data_cruncher)
+            sender: ID of sender
+            channel: ID of channel
+        """
+        try:
+            self.craft_response(msg, sender, channel)
+        except IndexError:
+            # woops, message was too short we index errored
+            return
 
 
 
-# client = SlackClient(token)
-# print(client.api_call(
-#     "chat.postMessage", channel="@jwang", text="Beep. Boop.",
-#     username=username, as_user=True))
-    
-    
-# using Slacker as it's file upload interface is much better
-client = Slacker(token)
-print(client.chat.post_message('@jwang', 'Beep. Boop.', username=username, as_user=True).raw)
-# print(client.files.upload('tmp.png', channels="@jwang",filename="HD_95086_160229_H_Spec.png", title="HD 95086 2016-02-29 H-Spec" ).raw)
+if __name__ == "__main__":
+    # client = SlackClient(token)
+    # print(client.api_call(
+    #     "chat.postMessage", channel="@jwang", text="Beep. Boop.",
+    #     username=username, as_user=True))
 
-# start up plotting thread
-plotter = Plotter()
-plotter.start()
 
-    
-# Run real time message slack client 
-sc = SlackClient(token)
+    # start up the render pool first, so the workers get forked before any other threads exist
+    render_pool = render.RenderPool(render_processes)
+    render_service = render.RenderService(render_pool, render_cache.RenderCache(render_cache_dir, render_cache_bytes), save_to_cache=cache_renders,
+                                          timeout=render_timeout_seconds)
+
+    # everything we post goes through the gateway. Its worker threads only start once the pool is forked
+    client = slack_gateway.SlackGateway(token, base_url=slack_api_url)
+    client.post_message('@jwang', 'Beep. Boop.', username=username).add_done_callback(slack_gateway.print_result)
 
-p = ChatResponder(dropboxdir, sc, client)
-p.daemon = True
-p.start()
 
+    # index what reductions we have, so requests don't need to go poking around Dropbox
+    dataset_index = datasets.DatasetIndex(dropboxdir, False)
+    dataset_index.scan()
+    llp_dataset_index = datasets.DatasetIndex(dropboxdir, True)
+    llp_dataset_index.scan()
 
+    # bring the catalog of reductions up to date in the background. Only changed files get read
+    reduction_catalog = catalog.ReductionCatalog(catalog_db)
+    def update_catalog():
+        reduction_catalog.scan(dataset_index)
+        reduction_catalog.scan(llp_dataset_index)
+    catalog_thread = Thread(target=update_catalog)
+    catalog_thread.daemon = True
+    catalog_thread.start()
 
-# Run real time PSF subtraction updater
-print(dropboxdir)
-event_handler = NewImagePoster(dropboxdir, client, 0)
-observer = Observer()
-observer.schedule(event_handler, os.path.join(dropboxdir, 'GPIDATA'), recursive=True)
-observer.start()
+    # Run real time message slack client 
+    sc = SlackClient(token)
+
+    p = ChatResponder(dropboxdir, sc, client, render_service, dataset_index, llp_dataset_index, reduction_catalog)
+    p.daemon = True
+    p.start()
+
+
+
+    # Run real time PSF subtraction updater
+    print(dropboxdir)
+    stable_file_scheduler = file_scheduler.StableFileScheduler(stable_seconds=file_stable_seconds)
+    stable_file_scheduler.start()
+    durable_post_queue = post_queue.PostQueue(post_queue_db, max_attempts=max_post_attempts)
+    print("{0} posts left over from last time".format(durable_post_queue.resume()))
+    post_rate_limiter = post_queue.RateLimiter(max_posts_per_hour)
+    event_handler = NewImagePoster(dropboxdir, client, render_service, dataset_index, reduction_catalog, stable_file_scheduler, durable_post_queue, post_rate_limiter)
+    event_handler_llp = NewImagePoster(dropboxdir, client, render_service, llp_dataset_index, reduction_catalog, stable_file_scheduler, durable_post_queue, post_rate_limiter, is_llp=True)
+
+    # only watch the autoreduced directories if we can
+    for poster, poster_index in [(event_handler, dataset_index), (event_handler_llp, llp_dataset_index)]:
+        if watch_mode != "recursive":
+            try:
+                watcher = watching.ScopedWatcher(poster, poster_index, poll_seconds=watch_poll_seconds, poll_only=watch_mode == "poll")
+                watcher.start()
+                continue
+            except OSError as e:
+                print("Can't watch just the autoreduced directories ({0}). Watching everything".format(e))
+        observer = Observer()
+        observer.schedule(poster, poster_index.rootdir, recursive=True)
+        observer.start()
 
-event_handler_llp = NewImagePoster(dropboxdir, client, 2, is_llp=True)
-observer_llp = Observer()
-observer_llp.schedule(event_handler_llp, os.path.join(dropboxdir, 'GPIDATA-LLP'), recursive=True)
-observer_llp.start()
+    # finish posting whatever we didn't get to before the last restart
+    for poster in [event_handler, event_handler_llp]:
+        resume_thread = Thread(target=poster.resume)
+        resume_thread.daemon = True
+        resume_thread.start()
 
+    # and look for anything that finished while we were down
+    catchup_thread = catchup.CatchUp([(os.path.join(dropboxdir, 'GPIDATA'), event_handler),
+                                      (os.path.join(dropboxdir, 'GPIDATA-LLP'), event_handler_llp)],
+                                     durable_post_queue, throttle_seconds=catchup_throttle_seconds)
+    catchup_thread.start()
 
-while True:
-    time.sleep(100)
+    while True:
+        time.sleep(100)
@@ -0,0 +1,179 @@
+"""
+Persistent SQLite catalog of every pyklip reduction the bot has seen, with what we can learn
+from the filename and the primary FITS header, so reductions can be looked up by metadata
+without walking Dropbox.
+"""
+import os
+import re
+import time
+import sqlite3
+import threading
+
+import astropy.io.fits as fits
+
+# e.g. pyklip-S20141218-H-k300a9s4m1-KLmodes-all.fits or pyklip-S20160229-H-pol-k100a9s1m1-ADI-KLmodes-all.fits
+pyklip_name_re = re.compile(r"^pyklip-S(?P<date>[0-9]{8})-(?P<band>[A-Za-z0-9]+)-(?P<pol>pol-)?"
+                            r"k(?P<k>[0-9]+)a(?P<annuli>[0-9]+)s(?P<subsections>[0-9]+)m(?P<movement>[0-9.]+)"
+                            r"(?P<nohp>-nohp)?(?P<adi>-ADI)?-KLmodes-all\.fits$")
+
+# primary header keywords we keep
+header_keywords = ["IFSFILT", "DISPERSR", "OBJECT"]
+
+
+def parse_pyklip_filename(filename):
+    """
+    Pull the reduction parameters out of a pyklip filename
+
+    Args:
+        filename: filename (no directory) of a pyklip reduction
+    Return:
+        params: dictionary of parameters, or None if it isn't a pyklip reduction
+    """
+    match = pyklip_name_re.match(filename)
+    if match is None:
+        return None
+    params = match.groupdict()
+    for key in ["pol", "nohp", "adi"]:
+        params[key] = int(params[key] is not None)
+    return params
+
+
+def is_reduction_path(path):
+    """
+    Whether a path looks like something the catalog keeps track of, without touching the file
+
+    Args:
+        path: full path to the file
+    Return:
+        is_reduction: True for pyklip reductions in an autoreduced directory
+    """
+    path_args = path.split(os.path.sep)
+    return len(path_args) >= 4 and path_args[-3] == "autoreduced" and parse_pyklip_filename(path_args[-1]) is not None
+
+
+class ReductionCatalog(object):
+    """
+    SQLite catalog of pyklip reductions. Object, band and mode match without caring about case.
+    Safe to use from multiple threads
+    """
+    def __init__(self, dbpath):
+        """
+        Args:
+            dbpath: path to the SQLite database. Made if it doesn't exist
+        """
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(dbpath, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS reductions ("
+                              "path TEXT PRIMARY KEY, is_llp INTEGER, object TEXT COLLATE NOCASE, date TEXT, "
+                              "band TEXT COLLATE NOCASE, mode TEXT COLLATE NOCASE, "
+                              "k INTEGER, annuli INTEGER, subsections INTEGER, movement TEXT, pol INTEGER, nohp INTEGER, adi INTEGER, "
+                              "ifsfilt TEXT, dispersr TEXT, header_object TEXT, mtime REAL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS reductions_by_object ON reductions (is_llp, object, date)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS reductions_by_band ON reductions (is_llp, band, mode, date)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS reductions_by_date ON reductions (is_llp, date)")
+
+    def update(self, path, is_llp):
+        """
+        Add a reduction to the catalog, or refresh it if it has changed since we last looked.
+        Only the primary header is read
+
+        Args:
+            path: full path to the file (GPIDATA*/objname/autoreduced/date_band_mode/filename)
+            is_llp: if this is LLP data
+        Return:
+            updated: True if the catalog entry was added or changed
+        """
+        if not is_reduction_path(path):
+            return False
+        path_args = path.split(os.path.sep)
+        params = parse_pyklip_filename(path_args[-1])
+
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return False
+
+        with self.lock:
+            row = self.conn.execute("SELECT mtime FROM reductions WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[0] == mtime:
+            # nothing new
+            return False
+
+        try:
+            header = fits.getheader(path, 0)
+        except Exception as e:
+            # probably still being written. We'll get it next time
+            print("Couldn't read header of {0}: {1}".format(path, e))
+            return False
+        header_values = [str(header[keyword]) if keyword in header else None for keyword in header_keywords]
+
+        dataset_args = path_args[-2].split("_")
+        mode = dataset_args[2] if len(dataset_args) > 2 else None
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO reductions VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                              [path, int(is_llp), path_args[-4], params["date"], params["band"], mode, 
+                               int(params["k"]), int(params["annuli"]), int(params["subsections"]), params["movement"],
+                               params["pol"], params["nohp"], params["adi"]] + header_values + [mtime])
+        return True
+
+    def remove(self, path):
+        """
+        Forget about a reduction (e.g. it was deleted)
+        """
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM reductions WHERE path = ?", (path,))
+
+    def scan(self, dataset_index):
+        """
+        Bring the catalog up to date with everything in a datasets.DatasetIndex. Only files that
+        are new or whose modification time changed get their headers read
+
+        Args:
+            dataset_index: a datasets.DatasetIndex that has been scanned
+        """
+        start_time = time.time()
+        paths = dataset_index.get_paths()
+        num_updated = 0
+        for path in paths:
+            if self.update(path, dataset_index.is_llp):
+                num_updated += 1
+
+        # drop anything that isn't there anymore
+        paths = set(paths)
+        with self.lock:
+            known_paths = [row[0] for row in self.conn.execute("SELECT path FROM reductions WHERE is_llp = ?", (int(dataset_index.is_llp),))]
+        for path in known_paths:
+            if path not in paths:
+                self.remove(path)
+
+        print("Catalog of {0} up to date. Looked at {1} files, read {2} headers in {3:.1f} s".format(
+              dataset_index.rootdir, len(paths), num_updated, time.time() - start_time))
+
+    def find_latest(self, is_llp, objname=None, band=None, mode=None):
+        """
+        Find the newest dataset that matches
+
+        Args:
+            is_llp: if we are looking for LLP data
+            objname: object name as it appears in the directory name (underscores, not spaces)
+            band: e.g. H
+            mode: Spec or Pol
+        Return:
+            objname, date, band, mode of the newest matching dataset, or None if nothing matches
+        """
+        query = "SELECT object, date, band, mode FROM reductions WHERE is_llp = ?"
+        args = [int(is_llp)]
+        if objname is not None:
+            query += " AND object = ?"
+            args.append(objname)
+        if band is not None:
+            query += " AND band = ?"
+            args.append(band)
+        if mode is not None:
+            query += " AND mode = ?"
+            args.append(mode)
+        query += " ORDER BY date DESC, mtime DESC LIMIT 1"
+
+        with self.lock:
+            return self.conn.execute(query, args).fetchone()
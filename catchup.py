@@ -0,0 +1,154 @@
+"""
+Catching up on reductions that showed up while the bot was down. watchdog only tells us about
+things that change while we're running, so at startup we walk the trees for anything newer than
+the last time we finished catching up, and send it through the normal posting path. While the
+bot runs, the high water mark keeps moving forward, so a restart only has to look back a little.
+"""
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# name of the high water mark in the post queue's markers
+high_water_mark_name = "catchup_high_water_mark"
+
+
+def parallel_walk(rootdir, match, cancel_event=None, threads=16):
+    """
+    Walk a directory tree with os.scandir, scanning many directories at once
+
+    Args:
+        rootdir: directory to start at
+        match: function that takes an os.DirEntry of a file and says whether we want it
+        cancel_event: optional threading.Event. If it gets set, the walk stops early
+        threads: number of directories to scan at once
+    Return:
+        matches: list of paths to the files we wanted
+        num_files: number of files looked at
+    """
+    def scan_dir(dirpath):
+        subdirs, found, num_files = [], [], 0
+        try:
+            entries = list(os.scandir(dirpath))
+        except OSError:
+            return subdirs, found, num_files
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                    continue
+                num_files += 1
+                if match(entry):
+                    found.append(entry.path)
+            except OSError:
+                # went away while we were looking
+                continue
+        return subdirs, found, num_files
+
+    matches = []
+    num_files = 0
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        not_done = set([executor.submit(scan_dir, rootdir)])
+        while len(not_done) > 0:
+            done, not_done = wait(not_done, return_when=FIRST_COMPLETED)
+            for future in done:
+                subdirs, found, num_dir_files = future.result()
+                matches += found
+                num_files += num_dir_files
+                if cancel_event is not None and cancel_event.is_set():
+                    continue
+                for subdir in subdirs:
+                    not_done.add(executor.submit(scan_dir, subdir))
+    return matches, num_files
+
+
+class CatchUp(threading.Thread):
+    """
+    Background thread that finds PSF subtractions and FMMF quicklooks that are newer than the
+    saved high water mark, and feeds them (slowly) to the NewImagePosters as if watchdog had just
+    told us about them. The posting path takes care of waiting for files to settle and of never
+    posting the same file twice. Once caught up, it keeps moving the high water mark forward
+    """
+    def __init__(self, posters, durable_post_queue, throttle_seconds=5., mark_seconds=600., overlap_seconds=3600.):
+        """
+        Args:
+            posters: list of (directory to walk, NewImagePoster for it)
+            durable_post_queue: a post_queue.PostQueue, which is where the high water mark lives
+            throttle_seconds: how long to wait between files we hand off
+            mark_seconds: how often to move the high water mark forward once caught up
+            overlap_seconds: how far behind now the high water mark is kept, so files that were
+                             still syncing or settling when the bot stopped get looked at again
+        """
+        super(CatchUp, self).__init__()
+        self.daemon = True
+        self.posters = posters
+        self.post_queue = durable_post_queue
+        self.throttle_seconds = throttle_seconds
+        self.mark_seconds = mark_seconds
+        self.overlap_seconds = overlap_seconds
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        """
+        Stop catching up as soon as possible. The high water mark isn't moved
+        """
+        self.cancel_event.set()
+
+    def run(self):
+        start_time = time.time()
+        high_water_mark = self.post_queue.get_marker(high_water_mark_name)
+        if high_water_mark is None:
+            # first time running. Don't post the entire archive
+            print("No catch-up high water mark yet. Starting from now")
+            self.post_queue.set_marker(high_water_mark_name, start_time)
+            self.keep_up()
+            return
+
+        def is_new_reduction(entry):
+            if not (entry.name.endswith("KLmodes-all.fits") or entry.name.endswith("_allquicklooks.png")):
+                return False
+            return entry.stat().st_mtime > high_water_mark
+
+        num_files, num_found, num_queued = 0, 0, 0
+        for rootdir, poster in self.posters:
+            found, num_walked = parallel_walk(rootdir, is_new_reduction, cancel_event=self.cancel_event)
+            num_files += num_walked
+            num_found += len(found)
+            print("Catch-up scan of {0} looked at {1} files in {2:.1f} s and found {3} new ones".format(
+                  rootdir, num_walked, time.time() - start_time, len(found)))
+
+            # oldest first. Files can get deleted or moved between the walk and now
+            dated = []
+            for path in found:
+                try:
+                    dated.append((os.path.getmtime(path), path))
+                except OSError:
+                    continue
+            found = sorted(dated)
+            for mtime, path in found:
+                if self.cancel_event.is_set():
+                    break
+                if self.post_queue.is_queued(path, mtime):
+                    # already queued since it last changed, no need to hash it again or wait
+                    num_queued += 1
+                    continue
+                poster.process_new_file_event(path)
+                self.cancel_event.wait(self.throttle_seconds)
+
+            if self.cancel_event.is_set():
+                print("Catch-up cancelled")
+                return
+
+        self.post_queue.set_marker(high_water_mark_name, start_time)
+        print("Caught up in {0:.1f} s. Looked at {1} files and found {2} new reductions ({3} of them already queued)".format(
+              time.time() - start_time, num_files, num_found, num_queued))
+        self.keep_up()
+
+    def keep_up(self):
+        """
+        Move the high water mark forward every so often until cancelled. watchdog sees everything
+        newer while we're running, so only the last overlap_seconds need another look after a restart
+        """
+        while not self.cancel_event.wait(self.mark_seconds):
+            high_water_mark = max(self.post_queue.get_marker(high_water_mark_name), time.time() - self.overlap_seconds)
+            self.post_queue.set_marker(high_water_mark_name, high_water_mark)
@@ -0,0 +1,438 @@
+"""
+Finding PSF subtracted (pyklip) reductions in the Dropbox autoreduced directories. 
+DatasetIndex keeps what's in there in memory so lookups don't have to touch the disk.
+"""
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import name_resolver
+
+
+def choose_folder(folders, date=None, band=None, mode=None):
+    """
+    Given subfolders in an autoreduced directory and some optional specifications,
+    find the best dataset to show
+
+    Args:
+        folders: a list of folders 
+        date: datestring (e.g 20141212)
+        band: e.g. H
+        mode Spec or Pol
+    Return:
+        chosen: chosen folder Name. None is nothing is chosen
+    """
+    # boudnary case of no folders
+    if len(folders) == 0:
+        return None
+
+    # limit by date
+    if date is not None:
+        folders = [folder for folder in folders if "{0}_".format(date) in folder]
+
+    # limit by band
+    if band is not None:
+        folders = [folder for folder in folders if "_{0}_".format(band) in folder]
+
+    # limit by mode
+    if mode is not None:
+        folders = [folder for folder in folders if "_{0}".format(mode) in folder]
+
+    # if more than one, pick a spec dataset in H band preferably. If not, just pick the first
+    if len(folders) > 1:
+        # narrow by spec if Pol not specified
+        if mode is None:
+            spec_folders = [folder for folder in folders if "_{0}".format("Spec") in folder]
+            # if there are spec datsets, let's pick those
+            if len(spec_folders) > 0:
+                folders = spec_folders
+        # narrow by H band if not specified
+        if band is None:
+            H_folders = [folder for folder in folders if "_{0}_".format("H") in folder]
+            # if there are H datasets, pick those
+            if len(H_folders) > 0:
+                folders = H_folders
+
+    # now pick the first one if we haven't removed all choices
+    if len(folders) > 0:
+        chosen = folders[0]
+    else:
+        chosen = None
+    return chosen
+
+
+def get_pyklip_name(date, band, mode, is_llp, has_file):
+    """
+    Figure out which pyklip reduction to show for a dataset
+
+    Args:
+        date: datestring (e.g 20141212)
+        band: e.g. H
+        mode: Spec or Pol
+        is_llp: if this is LLP data
+        has_file: function that takes a filename and says whether it exists in the dataset folder
+    Return:
+        pyklip_name: filename of the pyklip reduction
+    """
+    if mode == "Spec":
+        # in Spec, LLP has a different reduction set
+        if is_llp:
+            pyklip_name = "pyklip-S{date}-{band}-k50a9s1m1-nohp-ADI-KLmodes-all.fits"
+        else:
+            # new pyklip reductions
+            pyklip_name = "pyklip-S{date}-{band}-k300a9s4m1-KLmodes-all.fits"
+            # if they don't exist for this dataset, default to old ones
+            if not has_file(pyklip_name.format(date=date, band=band)):
+                pyklip_name = "pyklip-S{date}-{band}-k150a9s4m1-KLmodes-all.fits"
+    else:
+        pyklip_name = "pyklip-S{date}-{band}-pol-k100a9s1m1-ADI-KLmodes-all.fits"
+
+    return pyklip_name.format(date=date, band=band)
+
+
+class DatasetIndex(object):
+    """
+    In memory index of the autoreduced directories of one of the GPIDATA trees. Maps
+    object -> dataset folder (date_band_mode) -> files in it (and their modification times). Built with one parallel scan at
+    startup, and then kept up to date by feeding it the file events that watchdog gives us, 
+    so looking up a reduction never has to touch the disk. The object names are also kept in a
+    name_resolver.NameResolver (self.names) for fuzzy lookups.
+    """
+    def __init__(self, dropboxdir, is_llp, scan_threads=16):
+        """
+        Args:
+            dropboxdir: absolute dropbox path
+            is_llp: if True, index GPIDATA-LLP instead of GPIDATA
+            scan_threads: number of threads to scan object directories with
+        """
+        # configure whether LLP data or not
+        if is_llp:
+            GPIDATA_str = "GPIDATA-LLP"
+        else:
+            GPIDATA_str = "GPIDATA"
+        self.rootdir = os.path.join(dropboxdir, GPIDATA_str)
+        self.is_llp = is_llp
+        self.scan_threads = scan_threads
+        self.lock = threading.Lock()
+        self.objects = {} # objname -> {dataset folder -> {filename -> mtime}}
+        self.names = name_resolver.NameResolver()
+
+    def _scan_object(self, objname):
+        """
+        Read in the autoreduced directory of one object
+
+        Args:
+            objname: object directory name
+        Return:
+            datasets: {dataset folder -> {filename -> mtime}}, or None if there is no autoreduced directory
+        """
+        auto_dirpath = os.path.join(self.rootdir, objname, "autoreduced")
+        datasets = {}
+        try:
+            for dataset_entry in os.scandir(auto_dirpath):
+                if not dataset_entry.is_dir():
+                    continue
+                try:
+                    datasets[dataset_entry.name] = self._scan_dataset(dataset_entry.path)
+                except OSError:
+                    # went away while we were looking
+                    continue
+        except OSError:
+            return None
+        return datasets
+
+    def _scan_dataset(self, dataset_dirpath):
+        """
+        Read in one dataset folder. Raises OSError if it can't be listed
+
+        Args:
+            dataset_dirpath: full path to the dataset folder
+        Return:
+            filenames: {filename -> mtime} of the files in it
+        """
+        filenames = {}
+        for entry in os.scandir(dataset_dirpath):
+            try:
+                if entry.is_file():
+                    filenames[entry.name] = entry.stat().st_mtime
+            except OSError:
+                # went away while we were looking
+                continue
+        return filenames
+
+    def rescan_object(self, objname):
+        """
+        Read an object's autoreduced directory back in from disk
+
+        Args:
+            objname: object directory name
+        """
+        datasets = self._scan_object(objname)
+        with self.lock:
+            if datasets is None:
+                self.objects.pop(objname, None)
+                self.names.remove(objname)
+            else:
+                self.objects[objname] = datasets
+                self.names.add(objname)
+
+    def scan(self):
+        """
+        Build the index from scratch, scanning the object directories in parallel
+
+        Return:
+            num_datasets: number of dataset folders found
+        """
+        start_time = time.time()
+        try:
+            objnames = [entry.name for entry in os.scandir(self.rootdir) if entry.is_dir()]
+        except OSError as e:
+            print("Couldn't scan {0}: {1}".format(self.rootdir, e))
+            objnames = []
+
+        with ThreadPoolExecutor(max_workers=self.scan_threads) as executor:
+            scanned = list(executor.map(self._scan_object, objnames))
+
+        objects = {}
+        names = name_resolver.NameResolver()
+        for objname, datasets in zip(objnames, scanned):
+            if datasets is not None:
+                objects[objname] = datasets
+                names.add(objname)
+        with self.lock:
+            self.objects = objects
+            self.names = names
+
+        num_datasets = sum(len(datasets) for datasets in objects.values())
+        print("Indexed {0} datasets of {1} objects in {2} in {3:.1f} s".format(num_datasets, len(objects), self.rootdir, time.time() - start_time))
+        return num_datasets
+
+    def find_changes(self, objnames=None):
+        """
+        Scan object directories on disk and compare them to the index, without changing the index.
+        This is how changes get found when we can't watch the tree
+
+        Args:
+            objnames: list of object directory names to check. None for every object
+        Return:
+            added: list of full paths of files on disk that aren't in the index
+            removed: list of full paths of files in the index that aren't on disk
+            modified: list of full paths of files whose modification time isn't what the index has
+        """
+        if objnames is None:
+            try:
+                objnames = [entry.name for entry in os.scandir(self.rootdir) if entry.is_dir()]
+            except OSError as e:
+                print("Couldn't scan {0}: {1}".format(self.rootdir, e))
+                return [], [], []
+            with self.lock:
+                objnames = list(set(objnames) | set(self.objects.keys()))
+
+        with ThreadPoolExecutor(max_workers=self.scan_threads) as executor:
+            scanned = list(executor.map(self._scan_object, objnames))
+
+        added, removed, modified = [], [], []
+        for objname, datasets in zip(objnames, scanned):
+            # (dataset, filename) -> mtime
+            on_disk = dict(((dataset, filename), mtime) for dataset, filenames in (datasets or {}).items()
+                           for filename, mtime in filenames.items())
+            with self.lock:
+                indexed = dict(((dataset, filename), mtime) for dataset, filenames in self.objects.get(objname, {}).items()
+                               for filename, mtime in filenames.items())
+            auto_dirpath = os.path.join(self.rootdir, objname, "autoreduced")
+            added += [os.path.join(auto_dirpath, dataset, filename) for dataset, filename in on_disk.keys() - indexed.keys()]
+            removed += [os.path.join(auto_dirpath, dataset, filename) for dataset, filename in indexed.keys() - on_disk.keys()]
+            modified += [os.path.join(auto_dirpath, dataset, filename) for (dataset, filename), mtime in on_disk.items()
+                         if (dataset, filename) in indexed and indexed[(dataset, filename)] != mtime]
+        return added, removed, modified
+
+    def _split_path(self, path):
+        """
+        Split a path into its parts under the root directory. None if it's not under it
+        """
+        relpath = os.path.relpath(path, self.rootdir)
+        if relpath.startswith(os.pardir) or relpath == os.curdir:
+            return None
+        return relpath.split(os.path.sep)
+
+    def add_path(self, path):
+        """
+        Update the index for a file or directory that was created, modified or moved in
+
+        Args:
+            path: full path
+        """
+        path_args = self._split_path(path)
+        if path_args is None:
+            return
+        if len(path_args) <= 2:
+            # an object or its autoreduced directory showed up. Read it in
+            if len(path_args) == 1 or path_args[1] == "autoreduced":
+                self.rescan_object(path_args[0])
+            return
+        if path_args[1] != "autoreduced" or len(path_args) > 4:
+            return
+
+        objname, dataset = path_args[0], path_args[2]
+        if len(path_args) == 3:
+            # a dataset folder
+            if not os.path.isdir(path):
+                return
+            try:
+                filenames = self._scan_dataset(path)
+            except OSError:
+                return
+            with self.lock:
+                datasets = self.objects.setdefault(objname, {})
+                datasets.setdefault(dataset, {}).update(filenames)
+                self.names.add(objname)
+        else:
+            # a file in a dataset folder
+            if os.path.isdir(path):
+                return
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                return
+            with self.lock:
+                datasets = self.objects.setdefault(objname, {})
+                datasets.setdefault(dataset, {})[path_args[3]] = mtime
+                self.names.add(objname)
+
+    def remove_path(self, path):
+        """
+        Update the index for a file or directory that was deleted or moved away
+
+        Args:
+            path: full path
+        """
+        path_args = self._split_path(path)
+        if path_args is None:
+            return
+        with self.lock:
+            if len(path_args) == 1 or (len(path_args) == 2 and path_args[1] == "autoreduced"):
+                self.objects.pop(path_args[0], None)
+                self.names.remove(path_args[0])
+                return
+            if len(path_args) < 3 or len(path_args) > 4 or path_args[1] != "autoreduced":
+                return
+            datasets = self.objects.get(path_args[0])
+            if datasets is None:
+                return
+            if len(path_args) == 3:
+                datasets.pop(path_args[2], None)
+            elif path_args[2] in datasets:
+                datasets[path_args[2]].pop(path_args[3], None)
+
+    def get_paths(self):
+        """
+        Get the full path of every file in the index
+
+        Return:
+            paths: list of paths
+        """
+        with self.lock:
+            return [os.path.join(self.rootdir, objname, "autoreduced", dataset, filename)
+                    for objname, datasets in self.objects.items()
+                    for dataset, filenames in datasets.items()
+                    for filename in filenames]
+
+    def get_dataset_folders(self, objname):
+        """
+        Get the dataset folders (date_band_mode) of an object, newest first
+
+        Args:
+            objname: object directory name
+        Return:
+            folders: list of folder names. Empty if we don't know of the object
+        """
+        with self.lock:
+            datasets = self.objects.get(objname, {})
+            return sorted(datasets.keys(), reverse=True)
+
+    def has_file(self, objname, dataset, filename):
+        """
+        Check whether a file is in a dataset folder
+        """
+        with self.lock:
+            return filename in self.objects.get(objname, {}).get(dataset, ())
+
+    def resolve_name(self, name):
+        """
+        Figure out which object someone meant
+
+        Args:
+            name: object name as typed (e.g. "hr8799", "51 Eri")
+        Return:
+            objname: matching object directory name, or None if there isn't a clear match
+            suggestions: if there isn't a clear match, a list of close object directory names
+        """
+        with self.lock:
+            names = self.names
+        return names.resolve(name)
+
+    def find_klipped_img(self, objname, date=None, band=None, mode=None):
+        """
+        Find the Klipped image that best matches a request
+
+        Args:
+            objname: object name as it appears in the directory name (underscores, not spaces)
+            date: datestring (e.g 20141212)
+            band: e.g. H
+            mode: Spec or Pol
+
+        Returns:
+            filename: the full path to the klipped image
+            objname: object name (with spaces)
+            date: datestring
+            band: the band
+            mode: obsmode
+        """
+        date_folders = self.get_dataset_folders(objname)
+        if len(date_folders) == 0:
+            # no subdirs, uh oh
+            return None
+
+        datefolder = choose_folder(date_folders, date=date, band=band, mode=mode)
+        if datefolder is None:
+            # couldn't find it
+            return None
+
+        dateband = datefolder.split("_")
+        date = dateband[0]
+        band = dateband[1]
+        mode = dateband[2]
+
+        pyklip_name = get_pyklip_name(date, band, mode, self.is_llp, lambda filename: self.has_file(objname, datefolder, filename))
+
+        filename = os.path.join(self.rootdir, objname, "autoreduced", datefolder, pyklip_name)
+        return filename, objname.replace("_", " "), date, band, mode
+
+    def get_likely_requests(self, filepath):
+        """
+        Given a new reduction, figure out which reductions of that object people are likely to ask
+        for next. These are whatever find_klipped_img would pick for the object on its own, for the
+        object on that date, and for the object in each mode.
+
+        Args:
+            filepath: path to the new reduction (in GPIDATA*/objname/autoreduced/date_band_mode/)
+        Return:
+            filenames: list of paths to reductions that exist, without repeats
+        """
+        filepath_args = filepath.split(os.path.sep)
+        objname = filepath_args[-4]
+        date = filepath_args[-2].split("_")[0]
+
+        requests = [{}, {"date" : date}, {"mode" : "Spec"}, {"mode" : "Pol"}]
+
+        filenames = []
+        for request in requests:
+            klip_info = self.find_klipped_img(objname, **request)
+            if klip_info is None:
+                continue
+            filename = klip_info[0]
+            path_args = filename.split(os.path.sep)
+            if filename not in filenames and self.has_file(objname, path_args[-2], path_args[-1]):
+                filenames.append(filename)
+        return filenames
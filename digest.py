@@ -0,0 +1,180 @@
+"""
+Digest mode for automatic posts. Instead of a message and an upload for every new reduction,
+they get collected for a while (a fixed window, or until morning twilight) and posted all at
+once: one message listing every target and a montage of their quicklooks.
+"""
+import io
+import time
+import datetime
+import threading
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg') # headless, we only ever write PNGs
+import matplotlib.image
+import matplotlib.figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+import suntimes
+
+# matplotlib should only be used from one thread at a time, and digests and chat montages get made
+# on different threads. The render workers have their own copies, so they don't need this
+_matplotlib_lock = threading.Lock()
+
+
+def decode_png(png_data):
+    """
+    Read a PNG (e.g. from the render service) into an array
+
+    Args:
+        png_data: the PNG file contents (bytes)
+    Return:
+        rgb: (height, width, 3) array of uint8 RGB values
+    """
+    with _matplotlib_lock:
+        image = matplotlib.image.imread(io.BytesIO(png_data), format="png")
+    if image.dtype != np.uint8:
+        image = np.round(image * 255).astype(np.uint8)
+    if image.ndim == 2:
+        image = np.repeat(image[:, :, np.newaxis], 3, axis=2)
+    return image[:, :, :3]
+
+
+def make_caption(text, width, height=32, background=255):
+    """
+    Draw a line of text, centered, into a strip to go above an image. Uses matplotlib's Agg
+    canvas directly (no pyplot), one thread at a time
+
+    Args:
+        text: the caption
+        width: width of the strip in pixels
+        height: height of the strip in pixels
+        background: gray level behind the text
+    Return:
+        caption: (height, width, 3) array of uint8 RGB values
+    """
+    dpi = 100.
+    with _matplotlib_lock:
+        fig = matplotlib.figure.Figure(figsize=(width / dpi, height / dpi), dpi=dpi)
+        canvas = FigureCanvasAgg(fig)
+        fig.patch.set_facecolor(str(background / 255.))
+        # text half as tall as the strip. Font sizes are in points (1/72 inch)
+        fig.text(0.5, 0.5, text, ha="center", va="center", fontsize=0.5 * height * 72 / dpi)
+        canvas.draw()
+        rgba = np.array(canvas.buffer_rgba())
+    # figure sizes can come out a pixel off
+    caption = np.full((height, width, 3), background, dtype=np.uint8)
+    caption[:min(height, rgba.shape[0]), :min(width, rgba.shape[1])] = rgba[:height, :width, :3]
+    return caption
+
+
+def make_montage(images, captions=None, ncols=None, gap=8, background=255):
+    """
+    Tile images into a grid, left to right then top to bottom. Images smaller than the biggest
+    one sit in the top left corner of their cell
+
+    Args:
+        images: list of (height, width, 3) arrays of uint8 RGB values
+        captions: list of text to put above each image, or None for no captions
+        ncols: number of columns. Default is as square a grid as possible
+        gap: pixels between cells
+        background: gray level of the gaps and empty cells
+    Return:
+        montage: (height, width, 3) array of uint8 RGB values
+    """
+    if captions is not None:
+        images = [np.concatenate([make_caption(caption, image.shape[1], background=background), image])
+                  for image, caption in zip(images, captions)]
+    num_images = len(images)
+    if ncols is None:
+        ncols = int(np.ceil(np.sqrt(num_images)))
+    ncols = max(1, min(ncols, num_images))
+    nrows = int(np.ceil(num_images / float(ncols)))
+    cell_height = max(image.shape[0] for image in images) + gap
+    cell_width = max(image.shape[1] for image in images) + gap
+
+    # one cell per grid spot, then a single reshape lays them out
+    cells = np.full((nrows * ncols, cell_height, cell_width, 3), background, dtype=np.uint8)
+    for cell, image in zip(cells, images):
+        cell[:image.shape[0], :image.shape[1]] = image
+    montage = cells.reshape(nrows, ncols, cell_height, cell_width, 3).transpose(0, 2, 1, 3, 4)
+    montage = montage.reshape(nrows * cell_height, ncols * cell_width, 3)
+    # no gap needed after the last row and column
+    return montage[:montage.shape[0] - gap, :montage.shape[1] - gap]
+
+
+class Digest(object):
+    """
+    Collects things to post and hands them over in one go. The window starts when the first one
+    comes in. Safe to share between threads
+    """
+    def __init__(self, post_digest, window_seconds=3600., until_dawn=False):
+        """
+        Args:
+            post_digest: function called with the list of everything collected, from a timer thread
+            window_seconds: how long to collect for
+            until_dawn: if True, collect until morning twilight instead. During the day, window_seconds is used
+        """
+        self.post_digest = post_digest
+        self.window_seconds = window_seconds
+        self.until_dawn = until_dawn
+        self.entries = []
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def get_wait_time(self):
+        """
+        How long to collect for, starting now
+
+        Return:
+            wait_time: seconds
+        """
+        if self.until_dawn:
+            dawn = suntimes.get_end_of_night()
+            if dawn is not None:
+                return max(0., (dawn - datetime.datetime.utcnow()).total_seconds())
+        return self.window_seconds
+
+    def add(self, entry):
+        """
+        Add something to the next digest
+
+        Args:
+            entry: anything. It gets passed along to post_digest
+        """
+        with self.lock:
+            self.entries.append(entry)
+            if self.timer is not None:
+                return
+            wait_time = self.get_wait_time()
+            print("Starting a digest. Posting it in {0:.0f} s".format(wait_time))
+            self.timer = threading.Timer(wait_time, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        """
+        Post everything collected so far now
+        """
+        with self.lock:
+            entries, self.entries = self.entries, []
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        if len(entries) > 0:
+            self.post_digest(entries)
+
+
+if __name__ == "__main__":
+    # time tiling a night's worth of quicklook sized images
+    import sys
+    num_images = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    rng = np.random.RandomState(0)
+    images = [rng.randint(0, 256, size=(600 - 10 * (i % 3), 800, 3)).astype(np.uint8) for i in range(num_images)]
+    start_time = time.time()
+    montage = make_montage(images)
+    print("Tiled {0} images into a {1}x{2} montage in {3:.1f} ms".format(num_images, montage.shape[1], montage.shape[0],
+                                                                        (time.time() - start_time) * 1e3))
+    start_time = time.time()
+    montage = make_montage(images, captions=["Target {0}".format(i) for i in range(num_images)])
+    print("With captions: {0:.1f} ms".format((time.time() - start_time) * 1e3))
@@ -0,0 +1,133 @@
+"""
+Running chat commands in the background. Each channel gets a lane: commands from the same
+channel run one at a time in the order they came in, so replies stay in order, while different
+channels run in parallel. Slow work (e.g. waiting on a render and uploading it) goes to a
+separate pool, so cheap commands never wait behind it. How long things wait and run is kept
+track of for every type of command.
+"""
+import time
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+
+class CommandDispatcher(object):
+    """
+    Worker pools for chat commands, with per channel ordering
+    """
+    def __init__(self, workers=4, slow_workers=4):
+        """
+        Args:
+            workers: number of threads for commands (channels that can be worked on at once)
+            slow_workers: number of threads for slow work that doesn't need to be in order
+        """
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.slow_executor = ThreadPoolExecutor(max_workers=slow_workers)
+        self.lock = threading.Lock()
+        self.lanes = {} # channel -> deque of jobs waiting. Only there while the lane is busy
+        # command type -> [count, total wait, total run time, max wait, max run time]
+        self.timings = collections.defaultdict(lambda: [0, 0., 0., 0., 0.])
+
+    def submit(self, channel, command_type, func, *args):
+        """
+        Run a command after everything already submitted for its channel
+
+        Args:
+            channel: channel the command came from
+            command_type: name to keep timings under (e.g. "show")
+            func: function to run
+            args: arguments to pass to it
+        """
+        job = (command_type, func, args, time.time())
+        with self.lock:
+            lane = self.lanes.get(channel)
+            if lane is not None:
+                # channel is busy, wait our turn
+                lane.append(job)
+                return
+            self.lanes[channel] = collections.deque([job])
+        self.executor.submit(self._run_lane, channel)
+
+    def submit_slow(self, command_type, func, *args):
+        """
+        Run slow work that doesn't need to stay in order
+
+        Args:
+            command_type: name to keep timings under (e.g. "show upload")
+            func: function to run
+            args: arguments to pass to it
+        """
+        self.slow_executor.submit(self._run_job, (command_type, func, args, time.time()))
+
+    def submit_slow_when_done(self, futures, command_type, func, *args):
+        """
+        Run slow work once every one of some futures (e.g. renders) is done, without tying up a
+        thread while waiting on them
+
+        Args:
+            futures: list of concurrent.futures.Future
+            command_type: name to keep timings under (e.g. "show upload")
+            func: function to run
+            args: arguments to pass to it
+        """
+        remaining = [len(futures)]
+        remaining_lock = threading.Lock()
+
+        def future_done(future):
+            with remaining_lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            self.submit_slow(command_type, func, *args)
+
+        if len(futures) == 0:
+            self.submit_slow(command_type, func, *args)
+        for future in futures:
+            future.add_done_callback(future_done)
+
+    def _run_lane(self, channel):
+        """
+        Run the next command in a channel's lane. Gives the thread back after each command, so
+        a busy channel can't hog it
+        """
+        with self.lock:
+            job = self.lanes[channel][0]
+        self._run_job(job)
+        with self.lock:
+            lane = self.lanes[channel]
+            lane.popleft()
+            if len(lane) == 0:
+                del self.lanes[channel]
+                return
+        self.executor.submit(self._run_lane, channel)
+
+    def _run_job(self, job):
+        """
+        Run a job and keep track of how long it took
+        """
+        command_type, func, args, submit_time = job
+        start_time = time.time()
+        try:
+            func(*args)
+        except Exception as e:
+            print("Error running {0} command: {1}".format(command_type, e))
+        end_time = time.time()
+
+        wait_time, run_time = start_time - submit_time, end_time - start_time
+        with self.lock:
+            timing = self.timings[command_type]
+            timing[0] += 1
+            timing[1] += wait_time
+            timing[2] += run_time
+            timing[3] = max(timing[3], wait_time)
+            timing[4] = max(timing[4], run_time)
+
+    def stats(self):
+        """
+        Return:
+            stats: {command type -> dict of count, mean_wait, mean_run, max_wait, max_run (in seconds)}
+        """
+        with self.lock:
+            return dict((command_type, {"count" : count, "mean_wait" : total_wait / count, "mean_run" : total_run / count,
+                                        "max_wait" : max_wait, "max_run" : max_run})
+                        for command_type, (count, total_wait, total_run, max_wait, max_run) in self.timings.items())
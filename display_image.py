@@ -1,9 +1,26 @@
 import os
+import copy
+import zlib
+import warnings
+import struct
 import matplotlib
-import matplotlib.pylab as plt
+matplotlib.use('Agg') # headless, we only ever write PNGs
+import matplotlib.cm
 import astropy.io.fits as fits
 import numpy as np
 
+def get_date_from_filename(filename):
+    """
+    Get the observing date from the dataset folder of a file
+
+    Args:
+        filename: pull path to file
+    Return:
+        date: date as YYYYMMDD
+    """
+    return filename.split(os.path.sep)[-2].split("_")[0]
+
+
 def get_title_from_filename(filename):
     """
     Generate title by parsing filename
@@ -17,7 +34,7 @@ def get_title_from_filename(filename):
     objname = filepath_args[-4]
     objname = objname.replace("_", " ")
     dateband = filepath_args[-2].split("_")
-    date = dateband[0]
+    date = get_date_from_filename(filename)
     date = "{0}-{1}-{2}".format(date[0:4], date[4:6], date[6:8])
     band = dateband[1]
     mode = dateband[2]
@@ -26,24 +43,62 @@ def get_title_from_filename(filename):
     return title
 
 
-def save_klcube_image(filename, outputname, title=None):
+def is_fits_complete(filename):
     """
-    Open the PSF Subtraction saved as a KL Mode Cube and write the image as a PNG
-    in the path as specified by outputname
-    
+    Check whether a FITS file has been completely written (e.g. it's done syncing),
+    by checking the data of the last HDU ends inside the file
+
     Args:
-        filename: path to KL Mode cube to display
-        outputname: output PNG filepath
-        title: title of saved PNG plot
-        
+        filename: path to FITS file
     Return:
-        None
+        complete: True if every HDU is all there
+    """
+    try:
+        size = os.path.getsize(filename)
+        # FITS files come in 2880 byte blocks
+        if size == 0 or size % 2880 != 0:
+            return False
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            with fits.open(filename, memmap=True) as hdulist:
+                last_hdu = hdulist.fileinfo(len(hdulist) - 1)
+                return last_hdu['datLoc'] + last_hdu['datSpan'] <= size
+    except Exception:
+        return False
+
+
+def is_png_complete(filename):
     """
-    hdulist = fits.open(filename)
-    klcube = hdulist[1].data
-    frame50 = klcube[3]
-    band = hdulist[0].header['IFSFILT'].split("_")[1]
-    hdulist.close()
+    Check whether a PNG file has been completely written, by looking for the IEND chunk at the end
+
+    Args:
+        filename: path to PNG file
+    Return:
+        complete: True if the file ends like a PNG should
+    """
+    try:
+        with open(filename, "rb") as pngfile:
+            pngfile.seek(-12, os.SEEK_END)
+            return pngfile.read(12) == b"\x00\x00\x00\x00IEND\xaeB`\x82"
+    except (IOError, OSError):
+        return False
+
+
+def load_klcube_frame(filename):
+    """
+    Read in the frame we display from a KL Mode cube, with a rough throughput calibration applied
+
+    Args:
+        filename: path to KL Mode cube
+    Return:
+        frame50: the KL mode frame to display
+        band: the IFS filter band (e.g. H)
+    """
+    # memory map the file and only pull out the one KL mode plane we need, instead of the whole cube
+    with fits.open(filename, memmap=True) as hdulist:
+        band = hdulist[0].header['IFSFILT'].split("_")[1]
+        # private (native byte order) copy, so we can change it without touching the file
+        frame50 = np.array(hdulist[1].section[3], dtype=np.float64)
     
     # rough throuhghput calibration
     if 'methane' in filename:
@@ -51,43 +106,312 @@ def save_klcube_image(filename, outputname, title=None):
     else:
         throughput_corr = 0.65
     frame50 /= throughput_corr
-    
-    # make strictly positive for log stretch
-    minval = np.nanmin(frame50) - 1
-    log_frame = np.log(frame50 - minval)
 
-    # use statistics only from the middle of the image
-    y,x = np.indices(frame50.shape)
-    r = np.sqrt((x-140)**2 + (y-140)**2)
-    
+    return frame50, band
+
+
+# masks of the inner region of the image, indexed by (frame shape, radius). Made once and reused
+_inner_masks = {}
+
+def get_inner_mask(shape, band):
+    """
+    Get a boolean mask of the middle of the image, where we take the stretch statistics from
+
+    Args:
+        shape: (y, x) shape of the frame
+        band: the IFS filter band (e.g. H)
+    Return:
+        mask: boolean array that is True inside the inner region
+    """
     if band =='J' or band =='Y':
         innerradii = 100
     else:
         innerradii = 80
-    innerregion = np.where((r < innerradii))
-       
-    limits = [-3.e-7, np.min([np.nanpercentile(frame50[innerregion], 99.9), 8.e-5])]
-    
-    # set colormap to have nans as black
-    cmap = matplotlib.cm.viridis
-    cmap.set_bad('k',1.)
-    
-    # plot
-    fig = plt.figure()
-    ax = fig.add_subplot(111)
-    im = ax.imshow(log_frame, cmap=cmap, vmin=np.log(limits[0]-minval), vmax=np.log(limits[1]-minval))
-    ax.invert_yaxis()
 
+    key = (tuple(shape), innerradii)
+    if key not in _inner_masks:
+        # open grids broadcast against each other, so no full size index arrays get made
+        y, x = np.ogrid[:shape[0], :shape[1]]
+        _inner_masks[key] = ((x-140)**2 + (y-140)**2) < innerradii**2
+    return _inner_masks[key]
+
+
+def nanpercentile_inplace(values, q):
+    """
+    Percentile along the last axis, ignoring NaNs, with the same linear interpolation as
+    np.nanpercentile. Sorts values in place instead of making copies, so only use it on scratch arrays.
+
+    Args:
+        values: 1-D array, or 2-D array with one set of values per row
+        q: percentile (0 to 100)
+    Return:
+        percentile: scalar for 1-D input, array with one value per row for 2-D input
+    """
+    # NaNs sort to the end, so the valid values are the first num_valid of each row
+    num_valid = values.shape[-1] - np.count_nonzero(np.isnan(values), axis=-1)
+    pos = (q / 100.) * (num_valid - 1)
+    lower = np.floor(pos).astype(np.intp)
+    upper = np.ceil(pos).astype(np.intp)
+    frac = pos - lower
+
+    if values.ndim == 1:
+        if num_valid == 0:
+            return np.nan
+        # only need the two values either side, so a partial sort will do
+        values.partition((lower, upper))
+        return values[lower] + (values[upper] - values[lower]) * frac
+
+    values.sort(axis=-1)
+    lower = np.clip(lower, 0, None)[:, np.newaxis]
+    upper = np.clip(upper, 0, None)[:, np.newaxis]
+    lower_vals = np.take_along_axis(values, lower, axis=-1)[:, 0]
+    upper_vals = np.take_along_axis(values, upper, axis=-1)[:, 0]
+    percentile = lower_vals + (upper_vals - lower_vals) * frac
+    percentile[num_valid == 0] = np.nan
+    return percentile
+
+
+def get_stretch(frame50, band):
+    """
+    Figure out the log stretch for a frame, or a stack of frames from the same band
+
+    Args:
+        frame50: the KL mode frame to display, or a (N, y, x) stack of them
+        band: the IFS filter band (e.g. H)
+    Return:
+        log_frame: frame50 put on a log stretch
+        minval: offset subtracted off to make frame50 strictly positive (one per frame for a stack)
+        limits: [lower, upper] display limits in contrast (upper is one per frame for a stack)
+    """
+    # make strictly positive for log stretch
+    minval = np.nanmin(frame50, axis=(-2, -1)) - 1
+
+    # use statistics only from the middle of the image. 
+    # Boolean indexing makes the only copy, which then gets sorted in place
+    innerregion = frame50[..., get_inner_mask(frame50.shape[-2:], band)]
+    limits = [-3.e-7, np.minimum(nanpercentile_inplace(innerregion, 99.9), 8.e-5)]
+
+    # one new array for the log stretch, done in place
+    log_frame = frame50 - np.expand_dims(np.expand_dims(minval, -1), -1)
+    np.log(log_frame, out=log_frame)
+
+    return log_frame, minval, limits
+
+
+class KLCubeFigure(object):
+    """
+    A figure for plotting KL mode frames that is made once and then reused. The figure, axes, 
+    colorbar and title only get built the first time (or when the image size changes). After that,
+    each plot just swaps in the new image, color limits and labels, so no figures pile up in memory.
+    """
+    def __init__(self):
+        self.fig = None
+        self.shape = None
+
+        # set colormap to have nans as black. Copy it so we don't change everyone's viridis
+        self.cmap = copy.copy(matplotlib.cm.viridis)
+        self.cmap.set_bad('k',1.)
+
+    def build(self, shape):
+        """
+        Make the figure and all its artists
+
+        Args:
+            shape: shape of the images that will be plotted
+        """
+        # only pull in pyplot when we actually need a figure. Fast previews don't
+        import matplotlib.pylab as plt
+
+        if self.fig is not None:
+            plt.close(self.fig)
+
+        self.fig = plt.figure()
+        self.ax = self.fig.add_subplot(111)
+        self.im = self.ax.imshow(np.zeros(shape), cmap=self.cmap, vmin=0, vmax=1)
+        self.ax.invert_yaxis()
+
+        #add colorbar
+        self.cbar = self.fig.colorbar(self.im, ax=self.ax, orientation='vertical', shrink=0.9, pad=0.015)
+        self.cbar.set_label("Contrast", fontsize=12)
+        self.cbar.ax.tick_params(labelsize=12)
+
+        self.title = self.ax.set_title("")
+        self.shape = shape
+
+    def save(self, log_frame, minval, limits, outputname, title=None, dpi=None):
+        """
+        Plot a log stretched frame and save it
+
+        Args:
+            log_frame: frame to plot, already on a log stretch
+            minval: offset subtracted off before taking the log
+            limits: [lower, upper] display limits in contrast
+            outputname: output PNG filepath or file object (e.g. io.BytesIO)
+            title: title of saved PNG plot
+            dpi: resolution to save at. None for matplotlib's default
+        """
+        if self.fig is None or log_frame.shape != self.shape:
+            self.build(log_frame.shape)
+
+        vmin = np.log(limits[0]-minval)
+        vmax = np.log(limits[1]-minval)
+        self.im.set_data(log_frame)
+        self.im.set_clim(vmin, vmax)
+        self.cbar.update_normal(self.im)
+
+        ticks = [vmin, np.log(-minval), (vmin*2 + vmax)/3., (vmin + vmax*2)/3., vmax]
+        self.cbar.set_ticks(ticks)
+        self.cbar.set_ticklabels(["{0:.1e}".format(limits[0]), "0", "{0:.1e}".format(np.exp(ticks[2])+minval), "{0:.1e}".format(np.exp(ticks[3])+minval), "{0:.1e}".format(limits[1])])
+
+        self.title.set_text(title if title is not None else "")
+
+        self.fig.savefig(outputname, format="png", dpi=dpi)
+
+
+# one per process, since matplotlib should only be used from one thread
+_klcube_figure = KLCubeFigure()
+
+
+def save_klcube_image(filename, outputname, title=None, dpi=None):
+    """
+    Open the PSF Subtraction saved as a KL Mode Cube and write the image as a PNG
+    in the path as specified by outputname
     
-    #add colorbar
-    cbar = plt.colorbar(im, orientation='vertical', shrink=0.9, pad=0.015, ticks=[np.log(limits[0]-minval),np.log(-minval), (np.log(limits[0]-minval)*2 + np.log(limits[1]-minval))/3., (np.log(limits[0]-minval) + np.log(limits[1]-minval)*2)/3. ,np.log(limits[1]-minval)])
-    cbar.ax.set_yticklabels(["{0:.1e}".format(limits[0]), "0", "{0:.1e}".format((np.exp((np.log(limits[0]-minval)*2 + np.log(limits[1]-minval))/3))+minval), "{0:.1e}".format((np.exp((np.log(limits[0]-minval) + np.log(limits[1]-minval)*2)/3))+minval), "{0:.1e}".format(limits[1])])
-    cbar.set_label("Contrast", fontsize=12)
-    cbar.ax.tick_params(labelsize=12) 
-    
-    ax.set_title(title)
-    
-    plt.savefig(outputname)
+    Args:
+        filename: path to KL Mode cube to display
+        outputname: output PNG filepath or file object (e.g. io.BytesIO)
+        title: title of saved PNG plot
+        dpi: resolution to save at. None for matplotlib's default
+        
+    Return:
+        None
+    """
+    frame50, band = load_klcube_frame(filename)
+    log_frame, minval, limits = get_stretch(frame50, band)
+    _klcube_figure.save(log_frame, minval, limits, outputname, title=title, dpi=dpi)
+
+
+# lookup tables for fast previews, made the first time they are needed
+_preview_luts = {}
+
+def get_colormap_lut(name="viridis"):
+    """
+    Get a colormap as a lookup table of 8 bit RGB colors
+
+    Args:
+        name: name of a matplotlib colormap
+    Return:
+        lut: (256, 3) array of uint8 RGB values
+    """
+    if name not in _preview_luts:
+        cmap = getattr(matplotlib.cm, name)
+        _preview_luts[name] = np.round(cmap(np.linspace(0, 1, 256))[:, :3] * 255).astype(np.uint8)
+    return _preview_luts[name]
+
+
+def get_colorbar_strip(height, width=16, gap=4):
+    """
+    Get a vertical colorbar to stick on the side of a fast preview. Lowest values at the bottom
+
+    Args:
+        height: height of the image in pixels
+        width: width of the colorbar in pixels
+        gap: black pixels between the image and the colorbar
+    Return:
+        strip: (height, gap + width, 3) array of uint8 RGB values
+    """
+    key = ("strip", height, width, gap)
+    if key not in _preview_luts:
+        lut = get_colormap_lut()
+        strip = np.zeros((height, gap + width, 3), dtype=np.uint8)
+        levels = np.linspace(255, 0, height).astype(np.intp)
+        strip[:, gap:] = lut[levels][:, np.newaxis, :]
+        _preview_luts[key] = strip
+    return _preview_luts[key]
+
+
+def render_preview(log_frame, minval, limits):
+    """
+    Color a log stretched frame with viridis using only numpy. NaNs are drawn black
+
+    Args:
+        log_frame: frame to plot, already on a log stretch
+        minval: offset subtracted off before taking the log
+        limits: [lower, upper] display limits in contrast
+    Return:
+        rgb: (height, width, 3) array of uint8 RGB values, with a colorbar on the right
+    """
+    vmin = np.log(limits[0]-minval)
+    vmax = np.log(limits[1]-minval)
+
+    # scale to [0, 256) and then look up the colors, like matplotlib does
+    scaled = (log_frame - vmin) * (256. / (vmax - vmin))
+    bad = np.isnan(scaled)
+    scaled[bad] = 0
+    np.clip(scaled, 0, 255, out=scaled)
+    rgb = get_colormap_lut()[scaled.astype(np.uint8)]
+    rgb[bad] = 0
+
+    # origin at the bottom, to match the full plots
+    rgb = rgb[::-1]
+
+    return np.concatenate([rgb, get_colorbar_strip(rgb.shape[0])], axis=1)
+
+
+def encode_png(rgb):
+    """
+    Encode an RGB image as a PNG, no matplotlib needed
+
+    Args:
+        rgb: (height, width, 3) array of uint8 RGB values. First row is the top of the image
+    Return:
+        png_data: the PNG file contents (bytes)
+    """
+    height, width = rgb.shape[:2]
+    # each row starts with a filter type byte (0 = none)
+    raw = np.zeros((height, width*3 + 1), dtype=np.uint8)
+    raw[:, 1:] = rgb.reshape(height, width*3)
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+
+    return b"".join([b"\x89PNG\r\n\x1a\n", chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)),
+                     chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)), chunk(b"IEND", b"")])
+
+
+def write_png(rgb, outputname):
+    """
+    Write an RGB image straight to a PNG file, no matplotlib needed
+
+    Args:
+        rgb: (height, width, 3) array of uint8 RGB values. First row is the top of the image
+        outputname: output PNG filepath or file object (e.g. io.BytesIO)
+    """
+    png_data = encode_png(rgb)
+    if hasattr(outputname, "write"):
+        outputname.write(png_data)
+        return
+    with open(outputname, "wb") as pngfile:
+        pngfile.write(png_data)
+
+
+def save_klcube_preview(filename, outputname, title=None):
+    """
+    Fast preview version of save_klcube_image. Same stretch and limits, but colored with a lookup
+    table and written without matplotlib, so it takes milliseconds. There is no axes or text, so
+    the title isn't drawn. 
+
+    Args:
+        filename: path to KL Mode cube to display
+        outputname: output PNG filepath or file object (e.g. io.BytesIO)
+        title: unused, here so this can stand in for save_klcube_image
+
+    Return:
+        None
+    """
+    frame50, band = load_klcube_frame(filename)
+    log_frame, minval, limits = get_stretch(frame50, band)
+    write_png(render_preview(log_frame, minval, limits), outputname)
     
     
 # For testing purposes only
@@ -0,0 +1,137 @@
+"""
+Shrinking images before they get uploaded. Each channel can have its own encoding profile
+(set in config.ini): the resolution quicklooks are plotted at, whether to squeeze PNGs down to
+a 256 color palette, or to send lossy WebP/JPEG instead, and a maximum size to scale big images
+(e.g. FMMF quicklooks) down to. Re-encoding needs PIL (Pillow). Without it, images are sent as
+they are.
+"""
+import io
+import collections
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# dpi: resolution of full quicklook plots (None for matplotlib's default)
+# palette: if True, PNGs are quantized to 256 colors
+# format: "png", "webp" or "jpeg"
+# quality: quality of WebP/JPEG images (1-100)
+# max_size: images with a side longer than this (in pixels) get scaled down. 0 for no limit
+EncodingProfile = collections.namedtuple("EncodingProfile", ["dpi", "palette", "format", "quality", "max_size"])
+
+default_profile = EncodingProfile(dpi=None, palette=False, format="png", quality=85, max_size=0)
+
+file_extensions = {"png" : "png", "webp" : "webp", "jpeg" : "jpg"}
+
+_warned_no_pil = False
+
+
+def read_profiles(config):
+    """
+    Read encoding profiles from config. An [encoding] section sets the default for every channel,
+    and [encoding <channel>] sections (e.g. [encoding #gpies-data]) override it for one channel
+
+    Args:
+        config: a ConfigParser
+    Return:
+        profiles: dict of channel (upper case, "" for the default) -> EncodingProfile
+    """
+    def read_profile(section, base):
+        def get(key, convert):
+            if config.has_option(section, key) and key not in config.defaults():
+                return convert(config.get(section, key).strip())
+            return getattr(base, key)
+        return EncodingProfile(dpi=get("dpi", lambda value: float(value) if len(value) > 0 else None),
+                               palette=get("palette", lambda value: value.lower() in ("1", "yes", "true", "on")),
+                               format=get("format", lambda value: value.lower().replace("jpg", "jpeg")),
+                               quality=get("quality", int),
+                               max_size=get("max_size", int))
+
+    profiles = {}
+    if config.has_section("encoding"):
+        profiles[""] = read_profile("encoding", default_profile)
+    else:
+        profiles[""] = default_profile
+    for section in config.sections():
+        if section.lower().startswith("encoding "):
+            channel = section[len("encoding "):].strip().upper()
+            profiles[channel] = read_profile(section, profiles[""])
+    return profiles
+
+
+def get_profile(profiles, channel):
+    """
+    Get the encoding profile of a channel
+
+    Args:
+        profiles: from read_profiles()
+        channel: channel name or ID
+    Return:
+        profile: an EncodingProfile
+    """
+    return profiles.get(channel.upper(), profiles.get("", default_profile))
+
+
+def encode_image(image_data, profile, label=""):
+    """
+    Re-encode an image (PNG or anything else PIL can read) according to a profile, and print
+    how many bytes that saved
+
+    Args:
+        image_data: the image file contents (bytes)
+        profile: an EncodingProfile
+        label: what the image is, for the printout
+    Return:
+        encoded_data: the new image file contents (bytes)
+        extension: file extension that goes with it (e.g. "png")
+    """
+    global _warned_no_pil
+    if profile.format == "png" and not profile.palette and profile.max_size <= 0:
+        # nothing to do
+        print_savings(label, "png", len(image_data), len(image_data))
+        return image_data, "png"
+    if Image is None:
+        if not _warned_no_pil:
+            print("Can't re-encode images without PIL. Sending them as they are")
+            _warned_no_pil = True
+        print_savings(label, "png", len(image_data), len(image_data))
+        return image_data, "png"
+
+    image = Image.open(io.BytesIO(image_data))
+    resized = False
+    if profile.max_size > 0 and max(image.size) > profile.max_size:
+        image.thumbnail((profile.max_size, profile.max_size), Image.LANCZOS)
+        resized = True
+
+    output = io.BytesIO()
+    if profile.format == "jpeg":
+        image.convert("RGB").save(output, format="JPEG", quality=profile.quality, optimize=True)
+    elif profile.format == "webp":
+        image.convert("RGB").save(output, format="WEBP", quality=profile.quality, method=4)
+    else:
+        if profile.palette:
+            image = image.convert("RGB").quantize(colors=256)
+        image.save(output, format="PNG", optimize=True)
+    encoded_data = output.getvalue()
+    extension = file_extensions.get(profile.format, "png")
+
+    if len(encoded_data) >= len(image_data) and not resized:
+        # didn't help
+        encoded_data, extension = image_data, "png"
+    print_savings(label, extension, len(image_data), len(encoded_data))
+    return encoded_data, extension
+
+
+def print_savings(label, extension, original_size, encoded_size):
+    """
+    Print how many bytes encoding an image saved
+
+    Args:
+        label: what the image is
+        extension: file extension it's being sent as
+        original_size: bytes before
+        encoded_size: bytes after
+    """
+    print("Encoded {0} as {1}: {2} -> {3} bytes ({4} saved)".format(label, extension, original_size, encoded_size,
+                                                                   original_size - encoded_size))
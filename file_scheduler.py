@@ -0,0 +1,132 @@
+"""
+One place to wait for files to finish syncing. Dropbox writes big files as a long string of
+modify events, so instead of starting a timer thread per event, every event goes to a single
+scheduler thread that only acts once a file has stopped changing.
+"""
+import os
+import time
+import heapq
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class StableFileScheduler(threading.Thread):
+    """
+    Scheduler thread with a heap of timers, one per path. Events for a path that is already waiting
+    just push its timer back. When a timer goes off, the file is checked: if its size and 
+    modification time haven't changed for stable_seconds (and it looks complete), its callback is run
+    on a small fixed pool of worker threads. Otherwise we wait some more.
+    """
+    def __init__(self, stable_seconds=3., max_wait=3600., workers=4):
+        """
+        Args:
+            stable_seconds: how long a file needs to stay the same before it's ready
+            max_wait: give up on a file if it's still not ready after this many seconds
+            workers: number of threads to run callbacks on
+        """
+        super(StableFileScheduler, self).__init__()
+        self.daemon = True
+        self.stable_seconds = stable_seconds
+        self.max_wait = max_wait
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.cond = threading.Condition()
+        self.heap = [] # (due time, sequence number, path)
+        self.pending = {} # path -> dictionary of what we know about it
+        self.counter = itertools.count()
+
+    def _get_signature(self, path):
+        """
+        What we compare to see if a file changed. None if it's gone
+        """
+        try:
+            filestat = os.stat(path)
+        except OSError:
+            return None
+        return (filestat.st_size, filestat.st_mtime)
+
+    def schedule(self, path, callback, is_complete=None):
+        """
+        Run callback(path) once path has stopped changing. Calling this again for a path that is
+        already waiting starts its wait over (and replaces the callback)
+
+        Args:
+            path: path to the file (or directory)
+            callback: function to call with the path
+            is_complete: optional function that takes the path and says whether it's fully written
+        """
+        signature = self._get_signature(path)
+        now = time.time()
+        with self.cond:
+            entry = self.pending.get(path)
+            if entry is None:
+                entry = {"first_seen" : now}
+                self.pending[path] = entry
+            entry["callback"] = callback
+            entry["is_complete"] = is_complete
+            entry["signature"] = signature
+            entry["due"] = now + self.stable_seconds
+            heapq.heappush(self.heap, (entry["due"], next(self.counter), path))
+            self.cond.notify()
+
+    def num_pending(self):
+        """
+        Number of paths waiting to settle down
+        """
+        with self.cond:
+            return len(self.pending)
+
+    def run(self):
+        while True:
+            with self.cond:
+                # wait for the next timer
+                while len(self.heap) == 0:
+                    self.cond.wait()
+                due, _, path = self.heap[0]
+                now = time.time()
+                if due > now:
+                    self.cond.wait(due - now)
+                    continue
+                heapq.heappop(self.heap)
+                entry = self.pending.get(path)
+                if entry is None or entry["due"] != due:
+                    # an old timer for something that got pushed back
+                    continue
+                old_signature = entry["signature"]
+
+            # check on the file without holding up everyone else
+            signature = self._get_signature(path)
+            ready = signature is not None and signature == old_signature
+            if ready and entry["is_complete"] is not None:
+                ready = entry["is_complete"](path)
+
+            with self.cond:
+                if self.pending.get(path) is not entry or entry["due"] != due:
+                    # a new event came in while we were looking
+                    continue
+                if signature is None:
+                    # file went away
+                    del self.pending[path]
+                    continue
+                if not ready:
+                    if now - entry["first_seen"] > self.max_wait:
+                        print("Gave up waiting for {0} to finish syncing".format(path))
+                        del self.pending[path]
+                        continue
+                    # still changing. Check back later
+                    entry["signature"] = signature
+                    entry["due"] = now + self.stable_seconds
+                    heapq.heappush(self.heap, (entry["due"], next(self.counter), path))
+                    continue
+                del self.pending[path]
+
+            self.executor.submit(self._run_callback, entry["callback"], path)
+
+    def _run_callback(self, callback, path):
+        """
+        Run a callback on a worker thread, so one bad file doesn't take down the scheduler
+        """
+        try:
+            callback(path)
+        except Exception as e:
+            print("Error processing {0}: {1}".format(path, e))
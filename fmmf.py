@@ -0,0 +1,114 @@
+"""
+Finding new FMMF quicklooks. rsync fires lots of events for the big FMMF20xx directories, so 
+rather than walking the whole tree every time, we remember what each directory looked like and 
+only look at the one the event was for.
+"""
+import os
+import threading
+
+
+class FMMFDiscovery(object):
+    """
+    Remembers every directory under the FMMF directories it has been asked about: its 
+    modification time, its subdirectories, and the quicklooks in it (and their modification times). 
+    Only the directory asked about gets looked at, plus any subdirectories we haven't seen before. 
+    Subdirectories we already know about are left alone: quicklooks synced into them get events 
+    of their own. Safe to use from multiple threads.
+    """
+    def __init__(self, recent_hours=24.):
+        """
+        Args:
+            recent_hours: the first time we look at a FMMF directory, only quicklooks made within 
+                          this many hours of the directory's last change count as new
+        """
+        self.recent_hours = recent_hours
+        self.lock = threading.Lock()
+        # dirpath -> (mtime, list of subdirectory paths, {quicklook path : mtime})
+        self.dirs = {}
+
+    def find_new_quicklooks(self, dirpath):
+        """
+        Look for quicklooks that are new or have changed since last time in a directory, and in 
+        any new directories under it
+
+        Args:
+            dirpath: path to the directory that changed (e.g. the FMMF20xx directory)
+        Return:
+            new_quicklooks: list of paths to every new _allquicklooks.png
+        """
+        with self.lock:
+            try:
+                dir_mtime = os.stat(dirpath).st_mtime
+            except OSError:
+                self._forget(dirpath)
+                return []
+            first_time = dirpath not in self.dirs
+
+            new_quicklooks = []
+            to_scan = [(dirpath, dir_mtime)]
+            while len(to_scan) > 0:
+                scan_path, scan_mtime = to_scan.pop()
+                to_scan += self._scan_dir(scan_path, scan_mtime, new_quicklooks)
+
+        if first_time:
+            # don't count everything that was already there before we started as new
+            max_deltat = self.recent_hours * 3600
+            new_quicklooks = [(ql_filepath, qltime) for ql_filepath, qltime in new_quicklooks
+                              if abs(dir_mtime - qltime) <= max_deltat]
+        return [ql_filepath for ql_filepath, qltime in new_quicklooks]
+
+    def _scan_dir(self, dirpath, dir_mtime, new_quicklooks):
+        """
+        Update what we know about one directory. Call with the lock held
+
+        Args:
+            dirpath: path to the directory
+            dir_mtime: its current modification time
+            new_quicklooks: (path, mtime) of new or changed quicklooks get appended here
+        Return:
+            new_subdirs: list of (path, mtime) of subdirectories we didn't know about before
+        """
+        cached = self.dirs.get(dirpath)
+        if cached is not None and cached[0] == dir_mtime:
+            # nothing added, removed or renamed in it
+            return []
+        old_quicklooks = {} if cached is None else cached[2]
+
+        try:
+            entries = list(os.scandir(dirpath))
+        except OSError:
+            self._forget(dirpath)
+            return []
+        subdirs = []
+        quicklooks = {}
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append((entry.path, entry.stat(follow_symlinks=False).st_mtime))
+                elif entry.name.endswith("_allquicklooks.png"):
+                    quicklooks[entry.path] = entry.stat().st_mtime
+            except OSError:
+                # went away while we were looking
+                continue
+
+        current_subdirs = set(subdir for subdir, subdir_mtime in subdirs)
+        if cached is not None:
+            # forget about subdirectories that are gone
+            for subdir in cached[1]:
+                if subdir not in current_subdirs:
+                    self._forget(subdir)
+
+        for ql_filepath, qltime in quicklooks.items():
+            if old_quicklooks.get(ql_filepath) != qltime:
+                new_quicklooks.append((ql_filepath, qltime))
+
+        self.dirs[dirpath] = (dir_mtime, sorted(current_subdirs), quicklooks)
+        return [(subdir, subdir_mtime) for subdir, subdir_mtime in subdirs if subdir not in self.dirs]
+
+    def _forget(self, dirpath):
+        """
+        Forget a directory and everything under it. Call with the lock held
+        """
+        prefix = dirpath + os.path.sep
+        for known_dir in [known_dir for known_dir in self.dirs if known_dir == dirpath or known_dir.startswith(prefix)]:
+            del self.dirs[known_dir]
@@ -0,0 +1,144 @@
+"""
+Fuzzy matching of object names people type (e.g. "hr8799", "51 eri", "Gliese 504") to the
+object directory names in Dropbox (e.g. "HR_8799", "51_Eri", "GJ_504").
+"""
+import re
+import math
+import threading
+
+# things people put in front of names that we don't use in directory names
+ignored_prefixes = ["V*", "NAME ", "* "]
+# different ways of writing the same catalog, and the way we write it
+catalog_aliases = {"GLIESE" : "GJ", "GL" : "GJ", "HIP" : "HIP", "HD" : "HD", "HR" : "HR", "TYC" : "TYC", 
+                   "2MASS" : "2MASS", "2M" : "2MASS", "TWA" : "TWA", "KOI" : "KOI", "HII" : "HII"}
+catalog_alias_re = re.compile(r"^({0})(?=[0-9])".format("|".join(sorted(catalog_aliases, key=len, reverse=True))))
+
+
+def normalize_name(name):
+    """
+    Boil an object name down to a key that doesn't care about case, spaces, underscores, 
+    punctuation or how the catalog is written
+
+    Args:
+        name: object name or directory name
+    Return:
+        key: normalized key (e.g. "HR 8799", "hr_8799" and "HR8799" all give "HR8799")
+    """
+    name = name.strip().upper()
+    for prefix in ignored_prefixes:
+        if name.startswith(prefix):
+            name = name[len(prefix):]
+    key = re.sub(r"[^A-Z0-9+]", "", name)
+    return catalog_alias_re.sub(lambda match: catalog_aliases[match.group(1)], key)
+
+
+def get_trigrams(key):
+    """
+    Get the set of three character chunks of a key, padded so short keys still have some
+    """
+    padded = "^{0}$".format(key)
+    return set(padded[i:i+3] for i in range(len(padded) - 2))
+
+
+class NameResolver(object):
+    """
+    Index of object directory names for fuzzy lookups. Exact matches on the normalized key are a
+    dictionary lookup. Otherwise, candidates come from an inverted index of trigrams and are
+    ranked by how many trigrams they share with what was asked for.
+    """
+    def __init__(self, min_score=0.5):
+        """
+        Args:
+            min_score: minimum similarity (0 to 1) for a name to be a suggestion
+        """
+        self.min_score = min_score
+        self.lock = threading.Lock()
+        self.names = {} # normalized key -> set of directory names
+        self.trigram_index = {} # trigram -> set of normalized keys
+        self.num_trigrams = {} # normalized key -> how many trigrams it has
+
+    def add(self, name):
+        """
+        Add an object directory name
+        """
+        key = normalize_name(name)
+        with self.lock:
+            if key not in self.names:
+                self.names[key] = set()
+                trigrams = get_trigrams(key)
+                self.num_trigrams[key] = len(trigrams)
+                for trigram in trigrams:
+                    self.trigram_index.setdefault(trigram, set()).add(key)
+            self.names[key].add(name)
+
+    def remove(self, name):
+        """
+        Forget about an object directory name
+        """
+        key = normalize_name(name)
+        with self.lock:
+            if key not in self.names:
+                return
+            self.names[key].discard(name)
+            if len(self.names[key]) > 0:
+                return
+            del self.names[key]
+            del self.num_trigrams[key]
+            for trigram in get_trigrams(key):
+                keys = self.trigram_index.get(trigram)
+                if keys is not None:
+                    keys.discard(key)
+                    if len(keys) == 0:
+                        del self.trigram_index[trigram]
+
+    def resolve(self, query, max_suggestions=3):
+        """
+        Find the object directory someone meant
+
+        Args:
+            query: what they typed
+            max_suggestions: most "did you mean" names to give back
+        Return:
+            match: the directory name if there's a clear match, otherwise None
+            suggestions: if there's no clear match, a list of the closest directory names (best first)
+        """
+        key = normalize_name(query)
+        if len(key) == 0:
+            return None, []
+        trigrams = get_trigrams(key)
+
+        with self.lock:
+            if key in self.names:
+                return sorted(self.names[key])[0], []
+
+            # count up shared trigrams. To score well enough, a candidate has to share at least 
+            # min_shared trigrams, which means it has to have at least one of the rarest 
+            # len(trigrams) - min_shared + 1 of them. So only those get to add new candidates, 
+            # and the common ones (like "^HD") just get checked against the candidates we have
+            postings = sorted((self.trigram_index.get(trigram, set()) for trigram in trigrams), key=len)
+            min_shared = max(1, int(math.ceil(self.min_score * len(trigrams) / 2.)))
+            num_seeds = len(postings) - min_shared + 1
+            shared = {}
+            for posting in postings[:num_seeds]:
+                for candidate in posting:
+                    shared[candidate] = shared.get(candidate, 0) + 1
+            for posting in postings[num_seeds:]:
+                for candidate in shared:
+                    if candidate in posting:
+                        shared[candidate] += 1
+
+            # Dice similarity
+            scored = []
+            for candidate, num_shared in shared.items():
+                score = 2. * num_shared / (len(trigrams) + self.num_trigrams[candidate])
+                if score >= self.min_score:
+                    scored.append((score, candidate))
+            scored.sort(key=lambda scored_candidate: (-scored_candidate[0], scored_candidate[1]))
+            best = [(score, sorted(self.names[candidate])[0]) for score, candidate in scored[:max_suggestions]]
+
+        if len(best) == 0:
+            return None, []
+        # only go with the best one if it's good and clearly better than the next one
+        if best[0][0] >= 0.8 and (len(best) == 1 or best[0][0] - best[1][0] >= 0.15):
+            return best[0][1], []
+        return None, [name for score, name in best]
@@ -0,0 +1,219 @@
+"""
+Deciding what a path from a file event is: a PSF subtraction to post, a FMMF quicklook or
+directory, or (almost always) nothing we care about. The rules are regular expressions that can
+be changed in config.ini (in a [path_rules] section). They get compiled into one anchored pattern,
+and a cheap check of the file name's ending (or beginning) throws out most paths before the
+pattern even runs.
+"""
+import os
+import re
+import collections
+
+# kind: "klip" (PSF subtraction), "fmmf_quicklook" or "fmmf_dir"
+# mode: "Spec" or "Pol" for PSF subtractions, otherwise None
+PathClass = collections.namedtuple("PathClass", ["kind", "mode", "is_llp"])
+
+# file name patterns are matched against the end of the file name. Folder names are whole
+# directories somewhere in the path
+default_rules = {
+    "campaign_spec" : r"m1-KLmodes-all\.fits", # campaign spectral mode PSF subtractions
+    "llp_spec" : r"m1-(nohp-)?(ADI-)?KLmodes-all\.fits", # LLP spectral mode PSF subtractions
+    "pol" : r"m1-(ADI-)?KLmodes-all\.fits", # pol mode PSF subtractions, campaign or LLP
+    "pol_marker" : r"_Pol", # anything with this in the path is pol mode
+    "fmmf_folder" : r"autoreduced_kpop", # where FMMF reductions live
+    "fmmf_quicklook" : r"_allquicklooks\.png", # FMMF quicklooks
+    "fmmf_dir" : r"FMMF20[0-9]{2}", # FMMF directories
+    "excluded_folders" : r"Non-Campaign", # comma separated. FMMF stuff in these never gets posted
+}
+
+# a run of literal characters (or escaped punctuation) in a regular expression
+_literal_re = r"(?:\\[^A-Za-z0-9]|[A-Za-z0-9_ \-])+"
+
+
+def get_literal_suffix(pattern):
+    """
+    Find the literal text every match of a regular expression has to end with
+
+    Args:
+        pattern: regular expression
+    Return:
+        suffix: the literal text, or "" if there isn't any we can be sure of
+    """
+    match = re.search("(" + _literal_re + ")$", pattern)
+    if match is None or "|" in pattern:
+        return ""
+    return re.sub(r"\\(.)", r"\1", match.group(1))
+
+
+def get_literal_prefix(pattern):
+    """
+    Find the literal text every match of a regular expression has to start with
+
+    Args:
+        pattern: regular expression
+    Return:
+        prefix: the literal text, or "" if there isn't any we can be sure of
+    """
+    match = re.match("(" + _literal_re + ")", pattern)
+    if match is None or "|" in pattern:
+        return ""
+    literal = match.group(1)
+    if pattern[match.end():match.end() + 1] in ("?", "*", "{"):
+        # the last character is optional
+        literal = literal[:-2] if literal[-2:-1] == "\\" else literal[:-1]
+    return re.sub(r"\\(.)", r"\1", literal)
+
+
+class PathClassifier(object):
+    """
+    Classifies paths from one of the GPIDATA trees
+    """
+    def __init__(self, is_llp=False, rules=None):
+        """
+        Args:
+            is_llp: if True, classify paths from GPIDATA-LLP
+            rules: dict of rules to use instead of the ones in default_rules
+        """
+        self.is_llp = is_llp
+        self.rules = dict(default_rules)
+        if rules is not None:
+            self.rules.update(rules)
+        rules = self.rules
+
+        sep = re.escape(os.path.sep)
+        name = "[^{0}]*".format(sep) # rest of a file name
+        spec_rule = rules["llp_spec"] if is_llp else rules["campaign_spec"]
+        excluded = "|".join(folder.strip() for folder in rules["excluded_folders"].split(",") if len(folder.strip()) > 0)
+        kpop = "(?:.*{sep})?{fmmf}{sep}".format(sep=sep, fmmf=rules["fmmf_folder"]) # path through the FMMF folder
+
+        # the first one that matches wins, so the order matters
+        alternatives = ["(?P<pol>.*{marker}.*{sep}{name}(?:{pol}))".format(marker=rules["pol_marker"], sep=sep, name=name, pol=rules["pol"]),
+                        "(?P<pol_other>.*{marker}.*)".format(marker=rules["pol_marker"])]
+        if len(excluded) > 0:
+            alternatives.append("(?P<excluded>{kpop}(?:.*{sep})?(?:{excluded}){sep}.*)".format(kpop=kpop, sep=sep, excluded=excluded))
+        alternatives += ["(?P<fmmf_quicklook>{kpop}(?:.*{sep})?{name}(?:{ql}))".format(kpop=kpop, sep=sep, name=name, ql=rules["fmmf_quicklook"]),
+                         "(?P<fmmf_dir>{kpop}(?:.*{sep})?(?:{fmmf_dir}))".format(kpop=kpop, sep=sep, fmmf_dir=rules["fmmf_dir"]),
+                         "(?P<fmmf_other>{kpop}.*)".format(kpop=kpop),
+                         "(?P<spec>(?:.*{sep})?{name}(?:{spec}))".format(sep=sep, name=name, spec=spec_rule)]
+        self.pattern = re.compile("(?:" + "|".join(alternatives) + r")\Z", re.DOTALL)
+
+        # cheap check on the file name first. Only if every rule has some literal text to look for
+        suffixes, prefixes = [], []
+        for rule in [rules["pol"], spec_rule, rules["fmmf_quicklook"], rules["fmmf_dir"]]:
+            suffix = get_literal_suffix(rule)
+            if len(suffix) > 0:
+                suffixes.append(suffix)
+                continue
+            prefix = get_literal_prefix(rule)
+            if len(prefix) == 0:
+                suffixes, prefixes = None, None
+                break
+            prefixes.append(prefix)
+        self.suffixes = None if suffixes is None else tuple(suffixes)
+        self.prefixes = None if prefixes is None else tuple(prefixes)
+
+        self.results = {"pol" : PathClass("klip", "Pol", is_llp), "spec" : PathClass("klip", "Spec", is_llp),
+                        "fmmf_quicklook" : PathClass("fmmf_quicklook", None, is_llp), "fmmf_dir" : PathClass("fmmf_dir", None, is_llp)}
+
+    def classify(self, filepath):
+        """
+        Figure out what a path is
+
+        Args:
+            filepath: full path from a file event
+        Return:
+            path_class: a PathClass, or None if it's nothing we post
+        """
+        if self.suffixes is not None:
+            filename = filepath[filepath.rfind(os.path.sep) + 1:]
+            if not (filename.endswith(self.suffixes) or filename.startswith(self.prefixes)):
+                return None
+        match = self.pattern.match(filepath)
+        if match is None:
+            return None
+        return self.results.get(match.lastgroup)
+
+
+if __name__ == "__main__":
+    # micro-benchmark: classify a million made up but realistic paths, and check we agree with
+    # the chain of checks process_new_file_event used to do
+    import sys
+    import time
+    import random
+
+    def classify_old(filepath, is_llp):
+        if "_Pol" in filepath:
+            matches = re.findall(r".*m1-(ADI-)?KLmodes-all\.fits", filepath)
+            mode = "Pol"
+        elif "autoreduced_kpop" in filepath:
+            if "Non-Campaign" in filepath:
+                return None
+            if filepath.endswith("_allquicklooks.png"):
+                return "fmmf_quicklook"
+            elif re.match(r".*FMMF20[0-9]{2}$", filepath):
+                return "fmmf_dir"
+            return None
+        else:
+            mode = "Spec"
+            if is_llp:
+                matches = re.findall(r".*m1-(nohp-)?(ADI-)?KLmodes-all\.fits", filepath)
+            else:
+                matches = re.findall(r".*m1-KLmodes-all\.fits", filepath)
+        if len(matches) <= 0:
+            return None
+        return "klip " + mode
+
+    num_paths = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    rng = random.Random(42)
+    objects = ["HR_8799", "51_Eri", "HD_95086", "beta_Pic", "HD_206893", "c_Eri", "PDS_70", "HIP_65426"]
+    bands = ["Y", "J", "H", "K1", "K2"]
+
+    def make_path():
+        root = "/home/gpi/Dropbox (GPI)/GPIDATA" + rng.choice(["", "-LLP"])
+        obj = rng.choice(objects)
+        date = "20{0:02d}{1:02d}{2:02d}".format(rng.randint(14, 19), rng.randint(1, 12), rng.randint(1, 28))
+        band = rng.choice(bands)
+        mode = rng.choice(["Spec", "Spec", "Spec", "Pol"])
+        frame = "S{0}S{1:04d}".format(date, rng.randint(1, 400))
+        kind = rng.random()
+        if kind < 0.55:
+            # raw and reduced frames
+            return os.path.join(root, obj, "raw", date, frame + rng.choice([".fits", "_spdc.fits", "_podc.fits"]))
+        elif kind < 0.8:
+            # other stuff in autoreduced
+            return os.path.join(root, obj, "autoreduced", "{0}_{1}_{2}".format(date, band, mode),
+                                frame + rng.choice(["_spdc_distorcorr.fits", "_stokesdc.fits", ".log", "-satspots.txt"]))
+        elif kind < 0.9:
+            # PSF subtractions
+            klip = "pyklip-{0}-{1}-{2}k{3}a9s4m{4}-{5}KLmodes-all.fits".format(
+                frame[:9], band, "pol-" if mode == "Pol" else "", rng.choice([50, 150, 300]), rng.choice([1, 1, 1, 2]),
+                rng.choice(["", "ADI-", "nohp-ADI-"]))
+            return os.path.join(root, obj, "autoreduced", "{0}_{1}_{2}".format(date, band, mode), klip)
+        else:
+            # FMMF
+            fmmf_dir = os.path.join(root, "autoreduced_kpop", rng.choice(["", "Non-Campaign"]), "FMMF20{0}".format(date[2:4]))
+            return rng.choice([fmmf_dir, os.path.join(fmmf_dir, obj, "{0}_{1}_allquicklooks.png".format(obj, date)),
+                               os.path.join(fmmf_dir, obj, "{0}_{1}_fmmf.fits".format(obj, date))]).replace(os.path.sep * 2, os.path.sep)
+
+    paths = [make_path() for i in range(num_paths)]
+    for is_llp in [False, True]:
+        classifier = PathClassifier(is_llp=is_llp)
+
+        start_time = time.time()
+        old_results = [classify_old(path, is_llp) for path in paths]
+        old_time = time.time() - start_time
+
+        start_time = time.time()
+        new_results = [classifier.classify(path) for path in paths]
+        new_time = time.time() - start_time
+
+        num_different = 0
+        for old_result, new_result in zip(old_results, new_results):
+            if new_result is not None:
+                new_result = new_result.kind + ("" if new_result.mode is None else " " + new_result.mode)
+            if old_result != new_result:
+                num_different += 1
+        num_matched = sum(1 for result in new_results if result is not None)
+        print("{0}: {1} paths, {2} matched. Old: {3:.2f} s ({4:.2f} us/path). New: {5:.2f} s ({6:.2f} us/path). {7} disagreements".format(
+              "LLP" if is_llp else "Campaign", num_paths, num_matched, old_time, old_time / num_paths * 1e6,
+              new_time, new_time / num_paths * 1e6, num_different))
@@ -0,0 +1,283 @@
+"""
+Durable queue of things to post to Slack, kept in SQLite so it survives restarts. Every item is
+a file, identified by its path and a hash of its contents, so the same reduction never gets
+posted twice no matter how many times it gets synced or modified.
+"""
+import time
+import hashlib
+import collections
+import sqlite3
+import threading
+
+# states an item goes through
+PENDING = "pending"
+RENDERING = "rendering"
+UPLOADED = "uploaded"
+FAILED = "failed"
+ROLLED_UP = "rolled up" # too many to post one by one, so it went in a summary instead
+
+
+def get_content_hash(path):
+    """
+    Hash the contents of a file
+
+    Args:
+        path: path to the file
+    Return:
+        content_hash: hex string
+    """
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as queued_file:
+        for chunk in iter(lambda: queued_file.read(1024**2), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class PostQueue(object):
+    """
+    SQLite backed queue. Items go pending -> rendering -> uploaded (or failed), or get rolled up
+    into a summary if there are too many. The most recent observing dates are taken first. Adding, 
+    taking and finishing an item are each a single indexed statement, and nothing is kept in 
+    memory, so a backlog of thousands of files is fine. Safe to use from multiple threads.
+
+    Failed items get another go (up to max_attempts tries in all) at the next restart, or when
+    the same file shows up again, so a short Slack outage doesn't lose posts.
+    """
+    def __init__(self, dbpath, max_attempts=3):
+        """
+        Args:
+            dbpath: path to the SQLite database. Made if it doesn't exist
+            max_attempts: how many times to try posting an item before giving up on it for good
+        """
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(dbpath, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS posts ("
+                              "id INTEGER PRIMARY KEY AUTOINCREMENT, source TEXT, kind TEXT, path TEXT, content_hash TEXT, "
+                              "state TEXT, attempts INTEGER DEFAULT 0, error TEXT, created REAL, updated REAL, "
+                              "UNIQUE (path, content_hash))")
+            # observing date (YYYYMMDD) of each item, so tonight's data goes first
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(posts)")]
+            if "obsdate" not in columns:
+                self.conn.execute("ALTER TABLE posts ADD COLUMN obsdate TEXT DEFAULT ''")
+            self.conn.execute("DROP INDEX IF EXISTS posts_by_state")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS posts_by_date ON posts (source, kind, state, obsdate DESC, id)")
+            # other odds and ends we want to remember between restarts
+            self.conn.execute("CREATE TABLE IF NOT EXISTS markers (name TEXT PRIMARY KEY, value REAL)")
+
+    def enqueue(self, source, kind, path, obsdate=""):
+        """
+        Add a file to the queue, unless we've already seen this exact file (same path and contents).
+        If posting this exact file failed before, it gets another try, unless it's out of tries
+
+        Args:
+            source: who it's for (e.g. "campaign" or "llp")
+            kind: what sort of post it is (e.g. "klip" or "fmmf")
+            path: path to the file
+            obsdate: observing date as YYYYMMDD. More recent dates get posted first
+        Return:
+            added: True if it's new and was added, or is getting another try
+        """
+        try:
+            content_hash = get_content_hash(path)
+        except (IOError, OSError) as e:
+            print("Couldn't hash {0}: {1}".format(path, e))
+            return False
+        now = time.time()
+        with self.lock, self.conn:
+            cursor = self.conn.execute("INSERT OR IGNORE INTO posts (source, kind, path, content_hash, state, created, updated, obsdate) "
+                                       "VALUES (?,?,?,?,?,?,?,?)", (source, kind, path, content_hash, PENDING, now, now, obsdate))
+            if cursor.rowcount > 0:
+                return True
+            cursor = self.conn.execute("UPDATE posts SET state = ?, updated = ? WHERE path = ? AND content_hash = ? AND state = ? AND attempts < ?",
+                                       (PENDING, now, path, content_hash, FAILED, self.max_attempts))
+            return cursor.rowcount > 0
+
+    def claim(self, source, kind):
+        """
+        Take the pending item with the most recent observing date (oldest first for the same date)
+        and mark it as being worked on
+
+        Args:
+            source: who it's for
+            kind: what sort of post it is
+        Return:
+            (item_id, path, obsdate) of the item, or None if there's nothing pending
+        """
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT id, path, obsdate FROM posts WHERE source = ? AND kind = ? AND state = ? "
+                                    "ORDER BY obsdate DESC, id LIMIT 1", (source, kind, PENDING)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute("UPDATE posts SET state = ?, attempts = attempts + 1, updated = ? WHERE id = ?",
+                              (RENDERING, time.time(), row[0]))
+            return row[0], row[1], row[2]
+
+    def num_pending(self, source, kind, before_obsdate=None):
+        """
+        Count the items waiting to be posted
+
+        Args:
+            source: who it's for
+            kind: what sort of post it is
+            before_obsdate: YYYYMMDD. If given, only count items observed before this
+        Return:
+            num_pending: number of pending items
+        """
+        query = "SELECT COUNT(*) FROM posts WHERE source = ? AND kind = ? AND state = ?"
+        params = (source, kind, PENDING)
+        if before_obsdate is not None:
+            query += " AND obsdate < ?"
+            params += (before_obsdate,)
+        with self.lock:
+            return self.conn.execute(query, params).fetchone()[0]
+
+    def roll_up(self, source, kind, before_obsdate):
+        """
+        Take every pending item from before some observing date off the queue so they can be 
+        summarized in one post instead
+
+        Args:
+            source: who it's for
+            kind: what sort of post it is
+            before_obsdate: YYYYMMDD. Items observed before this are rolled up
+        Return:
+            paths: list of paths of the rolled up items, most recent first
+        """
+        with self.lock, self.conn:
+            rows = self.conn.execute("SELECT id, path FROM posts WHERE source = ? AND kind = ? AND state = ? AND obsdate < ? "
+                                     "ORDER BY obsdate DESC, id", (source, kind, PENDING, before_obsdate)).fetchall()
+            now = time.time()
+            self.conn.executemany("UPDATE posts SET state = ?, updated = ? WHERE id = ?",
+                                  [(ROLLED_UP, now, row[0]) for row in rows])
+        return [row[1] for row in rows]
+
+    def finish(self, item_id, error=None):
+        """
+        Mark an item as done
+
+        Args:
+            item_id: id from claim()
+            error: if it failed, what went wrong
+        """
+        state = UPLOADED if error is None else FAILED
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE posts SET state = ?, error = ?, updated = ? WHERE id = ?",
+                              (state, error, time.time(), item_id))
+
+    def resume(self):
+        """
+        At startup, put anything we were in the middle of when we stopped back to pending, and give
+        items that failed another try if they have tries left
+
+        Return:
+            num_pending: how many items are waiting to be posted
+        """
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE posts SET state = ? WHERE state = ?", (PENDING, RENDERING))
+            self.conn.execute("UPDATE posts SET state = ? WHERE state = ? AND attempts < ?", (PENDING, FAILED, self.max_attempts))
+            return self.conn.execute("SELECT COUNT(*) FROM posts WHERE state = ?", (PENDING,)).fetchone()[0]
+
+    def release(self, item_id):
+        """
+        Put a claimed item back to pending without counting it as a failure
+
+        Args:
+            item_id: id from claim()
+        """
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE posts SET state = ?, attempts = attempts - 1, updated = ? WHERE id = ?",
+                              (PENDING, time.time(), item_id))
+
+    def is_queued(self, path, since):
+        """
+        Whether a file was added to the queue after it last changed, i.e. there's no need to
+        hash it again
+
+        Args:
+            path: path to the file
+            since: when the file last changed (e.g. its modification time)
+        Return:
+            queued: True if it was added at or after since
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT 1 FROM posts WHERE path = ? AND created >= ? LIMIT 1", (path, since)).fetchone()
+        return row is not None
+
+    def get_marker(self, name):
+        """
+        Get a saved number (e.g. a timestamp)
+
+        Args:
+            name: name of the marker
+        Return:
+            value: the saved value, or None if it was never set
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM markers WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def set_marker(self, name, value):
+        """
+        Save a number (e.g. a timestamp) so it's there after a restart
+
+        Args:
+            name: name of the marker
+            value: number to save
+        """
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO markers VALUES (?,?)", (name, value))
+
+
+class RateLimiter(object):
+    """
+    Keeps track of how many posts have gone out recently, so we don't flood Slack. Safe to share
+    between threads
+    """
+    def __init__(self, max_posts, period=3600.):
+        """
+        Args:
+            max_posts: how many posts are allowed per period. 0 or less for no limit
+            period: length of the period in seconds
+        """
+        self.max_posts = max_posts
+        self.period = period
+        self.lock = threading.Lock()
+        self.post_times = collections.deque()
+
+    def _time_until_free(self, now):
+        """
+        How long until another post is allowed. Call with the lock held
+        """
+        if self.max_posts <= 0:
+            return 0
+        while len(self.post_times) > 0 and self.post_times[0] <= now - self.period:
+            self.post_times.popleft()
+        if len(self.post_times) < self.max_posts:
+            return 0
+        return self.post_times[0] + self.period - now
+
+    def time_until_free(self):
+        """
+        Return:
+            wait_time: seconds until another post is allowed (0 if it is now)
+        """
+        with self.lock:
+            return self._time_until_free(time.time())
+
+    def try_acquire(self):
+        """
+        Count a post if we're under the limit
+
+        Return:
+            allowed: True if the post can go out now
+        """
+        with self.lock:
+            now = time.time()
+            if self._time_until_free(now) > 0:
+                return False
+            self.post_times.append(now)
+            return True
@@ -0,0 +1,308 @@
+"""
+Render backend for the Data Cruncher. Quicklook images are made by a pool of
+worker processes, each with its own headless (Agg) copy of matplotlib, so
+several KL mode cubes can be plotted at the same time.
+"""
+import io
+import os
+import time
+import heapq
+import itertools
+import threading
+import multiprocessing
+from concurrent.futures import Future
+
+import matplotlib
+
+# render priorities, most urgent first
+INTERACTIVE = 0 # someone in chat is waiting on it
+AUTOMATIC = 1 # new reductions being posted
+PREWARM = 2 # might be asked for later
+
+
+class RenderTimeout(Exception):
+    """
+    The pool took too long with a render (e.g. its worker died), so we gave up on it
+    """
+    pass
+
+
+def _init_worker():
+    """
+    Runs once in each worker process before it takes any jobs
+    """
+    # no displays on the render workers
+    matplotlib.use('Agg')
+
+
+def render_klcube(filepath, outputname=None, fast=False, dpi=None):
+    """
+    Plot a KL mode cube to a PNG in memory. Runs inside a worker process.
+
+    Args:
+        filepath: path to the KL mode cube
+        outputname: if not None, also save the PNG here
+        fast: if True, make a fast preview (no matplotlib figure) instead of a full plot
+        dpi: resolution of full plots. None for matplotlib's default
+    Return:
+        png_data: the PNG file contents (bytes)
+    """
+    import display_image
+    title = display_image.get_title_from_filename(filepath) # parse title from filepath
+    png_buffer = io.BytesIO()
+    if fast:
+        display_image.save_klcube_preview(filepath, png_buffer, title=title)
+    else:
+        display_image.save_klcube_image(filepath, png_buffer, title=title, dpi=dpi)
+    png_data = png_buffer.getvalue()
+
+    if outputname is not None:
+        # write to a scratch file first, so nobody ever reads a half written PNG
+        scratchname = "{0}.{1}.png".format(os.path.splitext(outputname)[0], os.getpid())
+        with open(scratchname, "wb") as scratchfile:
+            scratchfile.write(png_data)
+        os.replace(scratchname, outputname)
+    return png_data
+
+
+class RenderPool(object):
+    """
+    A pool of render processes. Create this before starting any other threads
+    so the workers are forked from a quiet process.
+    """
+    def __init__(self, processes=0):
+        """
+        Args:
+            processes: number of worker processes. 0 or less uses one per core
+        """
+        if processes <= 0:
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+        self.pool = multiprocessing.Pool(processes=processes, initializer=_init_worker)
+
+    def submit(self, filepath, outputname=None, fast=False, dpi=None, callback=None, error_callback=None):
+        """
+        Queue up a KL mode cube to be plotted
+
+        Args:
+            filepath: path to the KL mode cube
+            outputname: if not None, also save the PNG here
+            fast: if True, make a fast preview instead of a full plot
+            dpi: resolution of full plots. None for matplotlib's default
+            callback: called with the PNG file contents (bytes) once the image has been made
+            error_callback: called with the exception if the render failed
+        Return:
+            result: a multiprocessing AsyncResult
+        """
+        return self.pool.apply_async(render_klcube, (filepath, outputname, fast, dpi), callback=callback,
+                                     error_callback=error_callback)
+
+    def close(self):
+        """
+        Stop taking new jobs and wait for the workers to finish
+        """
+        self.pool.close()
+        self.pool.join()
+
+
+class RenderService(object):
+    """
+    Front end to the render pool that hands back a future for every request, so any number of
+    callers can wait on renders at once. Images come back as PNG data in memory. They can also
+    be kept in a RenderCache, so asking for the same thing again doesn't render it again. Requests for a file that is already being 
+    rendered share that render (and its result) instead of starting another one.
+
+    Requests wait in a priority queue and are handed to the pool only when a worker is free, so
+    people asking for images in chat always go ahead of automatic posts, which go ahead of 
+    prewarming. Prewarm renders (images rendered into the cache ahead of time) only ever use 
+    workers that nobody else needs.
+
+    If a worker dies mid render (e.g. out of memory on a big cube), multiprocessing never says so,
+    so renders the pool has had for longer than timeout fail with RenderTimeout and their worker
+    slot is given back.
+    """
+    def __init__(self, render_pool, render_cache, save_to_cache=True, timeout=300.):
+        """
+        Args:
+            render_pool: a RenderPool instance
+            render_cache: a render_cache.RenderCache instance to keep the PNGs in
+            save_to_cache: if False, nothing gets written to (or read from) the render cache
+            timeout: seconds the pool gets to finish a render. 0 to wait forever
+        """
+        self.render_pool = render_pool
+        self.render_cache = render_cache
+        self.save_to_cache = save_to_cache
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.inflight = {} # renders waiting or in progress, indexed by cache key
+        self.running = set() # cache keys of the renders the pool is working on
+        self.deadlines = {} # cache key -> when we give up on a render the pool is working on
+
+        # heap of (priority, order, key, filepath, fast, dpi) waiting for a worker
+        self.waiting = []
+        self.order = itertools.count()
+        # always leave one worker free for real requests unless there is only one
+        self.prewarm_slots = max(1, render_pool.processes - 1)
+        self.worker_freed = threading.Condition(self.lock)
+        self.dispatch_thread = threading.Thread(target=self._dispatch_loop)
+        self.dispatch_thread.daemon = True
+        self.dispatch_thread.start()
+
+    def render(self, filepath, fast=False, priority=INTERACTIVE, dpi=None):
+        """
+        Ask for a KL mode cube to be plotted
+
+        Args:
+            filepath: path to the KL mode cube
+            fast: if True, make a fast preview (display_image.save_klcube_preview) instead of a full plot
+            priority: INTERACTIVE, AUTOMATIC or PREWARM
+            dpi: resolution of full plots. None for matplotlib's default
+        Return:
+            future: a concurrent.futures.Future whose result is the PNG file contents (bytes)
+        """
+        future = Future()
+        try:
+            if dpi is None:
+                key = self.render_cache.get_key(filepath, fast)
+            else:
+                key = self.render_cache.get_key(filepath, fast, dpi)
+        except OSError as e:
+            # file's not there
+            future.set_exception(e)
+            return future
+
+        if self.save_to_cache:
+            cached_path = self.render_cache.get(key)
+            if cached_path is not None:
+                # already made this one
+                try:
+                    with open(cached_path, "rb") as cached_file:
+                        future.set_result(cached_file.read())
+                    return future
+                except IOError:
+                    # got evicted just now
+                    pass
+
+        with self.lock:
+            inflight_future = self.inflight.get(key)
+            if inflight_future is not None:
+                # someone already asked for this one
+                future = inflight_future
+            else:
+                future.set_running_or_notify_cancel()
+                self.inflight[key] = future
+            if key not in self.running:
+                # if it's already waiting at a lower priority, this entry gets to the pool first
+                # and the old one is skipped
+                heapq.heappush(self.waiting, (priority, next(self.order), key, filepath, fast, dpi))
+                self.worker_freed.notify()
+        return future
+
+    def _can_dispatch(self):
+        """
+        Whether the most urgent waiting render can go to the pool now. Call with the lock held
+        """
+        if len(self.waiting) == 0:
+            return False
+        if self.waiting[0][0] >= PREWARM:
+            return len(self.running) < self.prewarm_slots
+        return len(self.running) < self.render_pool.processes
+
+    def _expire_overdue(self):
+        """
+        Give up on renders the pool has had for too long. Call with the lock held
+
+        Return:
+            expired: list of (key, future) of the renders given up on
+        """
+        now = time.time()
+        expired = []
+        for key in [key for key, deadline in self.deadlines.items() if deadline <= now]:
+            del self.deadlines[key]
+            self.running.discard(key)
+            expired.append((key, self.inflight.pop(key)))
+        return expired
+
+    def _time_to_next_deadline(self):
+        """
+        Seconds until the next render needs to be given up on, or None if nothing is running. Call
+        with the lock held
+        """
+        if len(self.deadlines) == 0:
+            return None
+        return max(0., min(self.deadlines.values()) - time.time())
+
+    def _dispatch_loop(self):
+        """
+        Hands waiting renders to the pool, most urgent first, whenever there are free workers,
+        and gives up on renders that are taking too long
+        """
+        while True:
+            job = None
+            with self.lock:
+                expired = self._expire_overdue()
+                if self._can_dispatch():
+                    priority, order, key, filepath, fast, dpi = heapq.heappop(self.waiting)
+                    # otherwise it was already sent at a higher priority
+                    if key not in self.running and key in self.inflight:
+                        self.running.add(key)
+                        if self.timeout > 0:
+                            self.deadlines[key] = time.time() + self.timeout
+                        job = (key, filepath, fast, dpi, self.inflight[key])
+                elif len(expired) == 0:
+                    self.worker_freed.wait(self._time_to_next_deadline())
+
+            for key, future in expired:
+                print("Gave up on rendering {0} after {1:.0f} s".format(key, self.timeout))
+                future.set_exception(RenderTimeout("render took longer than {0:.0f} s".format(self.timeout)))
+            if job is None:
+                continue
+            key, filepath, fast, dpi, future = job
+            outputname = self.render_cache.get_path(key) if self.save_to_cache else None
+            self.render_pool.submit(filepath, outputname, fast=fast, dpi=dpi,
+                                    callback=lambda png_data, key=key, future=future: self._finish(key, future, result=png_data),
+                                    error_callback=lambda err, key=key, future=future: self._finish(key, future, err=err))
+
+    def _finish(self, key, future, result=None, err=None):
+        """
+        Runs when the pool is done with a request. Hands the result to everyone waiting on it
+
+        Args:
+            key: cache key of the request
+            future: the future for this request
+            result: the PNG file contents if it worked
+            err: the exception raised if it didn't
+        """
+        if err is None and self.save_to_cache:
+            self.render_cache.record(key)
+        with self.lock:
+            if self.inflight.get(key) is not future:
+                # we gave up on it already
+                return
+            del self.inflight[key]
+            self.running.discard(key)
+            self.deadlines.pop(key, None)
+            self.worker_freed.notify()
+        if err is not None:
+            future.set_exception(err)
+        else:
+            future.set_result(result)
+
+    def prewarm(self, filepath, fast=False, dpi=None):
+        """
+        Get an image into the cache ahead of time. Only renders when there are spare workers,
+        so it never holds up a real request. Nobody waits on the result
+
+        Args:
+            filepath: path to the KL mode cube
+            fast: if True, make a fast preview instead of a full plot
+            dpi: resolution of full plots. None for matplotlib's default
+        """
+        if not self.save_to_cache:
+            # nowhere to keep it
+            return
+
+        def report_error(future):
+            if future.exception() is not None:
+                print("Couldn't prewarm {0}: {1}".format(filepath, future.exception()))
+        self.render(filepath, fast=fast, priority=PREWARM, dpi=dpi).add_done_callback(report_error)
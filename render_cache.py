@@ -0,0 +1,141 @@
+"""
+On disk cache of rendered quicklook PNGs. Entries are named by a hash of the FITS file's path,
+size and modification time plus the render parameters, so a changed file never hits a stale image.
+"""
+import os
+import time
+import hashlib
+import threading
+
+
+class RenderCache(object):
+    """
+    A directory of rendered PNGs with a byte budget. When it goes over budget, the least recently
+    used images get thrown out. Files are only ever moved into place with an atomic rename, so 
+    readers never see a partial image.
+    """
+    def __init__(self, cachedir, max_bytes, grace_period=120):
+        """
+        Args:
+            cachedir: directory to keep the PNGs in. Made if it doesn't exist
+            max_bytes: byte budget for the cache
+            grace_period: seconds after an image is used where it won't be evicted, 
+                          so whoever just got it has time to upload it
+        """
+        self.cachedir = cachedir
+        self.max_bytes = max_bytes
+        self.grace_period = grace_period
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+
+        # figure out what's already in there, and clean up anything left half written
+        self.total_bytes = 0
+        for entry in os.listdir(cachedir):
+            entry_path = os.path.join(cachedir, entry)
+            if not entry.endswith(".png"):
+                continue
+            if "." in entry[:-4]:
+                # scratch file from a render that never finished
+                os.remove(entry_path)
+                continue
+            self.total_bytes += os.path.getsize(entry_path)
+
+    def get_key(self, filepath, *params):
+        """
+        Get the cache key for rendering a file
+
+        Args:
+            filepath: path to the FITS file
+            params: anything else that changes what the image looks like
+        Return:
+            key: the cache key (a hex string)
+        """
+        filestat = os.stat(filepath)
+        description = repr((os.path.abspath(filepath), filestat.st_size, filestat.st_mtime, params))
+        return hashlib.sha1(description.encode("utf-8")).hexdigest()
+
+    def get_path(self, key):
+        """
+        Where the image for a key lives (whether or not it's been made yet)
+        """
+        return os.path.join(self.cachedir, "{0}.png".format(key))
+
+    def get(self, key):
+        """
+        Look up an image
+
+        Args:
+            key: the cache key
+        Return:
+            path: path to the cached PNG, or None if it isn't cached
+        """
+        path = self.get_path(key)
+        try:
+            # mark it as recently used
+            os.utime(path, None)
+        except OSError:
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return path
+
+    def record(self, key):
+        """
+        Let the cache know a new image has been moved into get_path(key). Evicts old images if 
+        we are now over budget
+
+        Args:
+            key: the cache key
+        """
+        size = os.path.getsize(self.get_path(key))
+        with self.lock:
+            self.total_bytes += size
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        """
+        Throw out least recently used images until we are under 90% of the budget. Call with self.lock held
+        """
+        entries = []
+        self.total_bytes = 0
+        for entry in os.listdir(self.cachedir):
+            if not entry.endswith(".png") or "." in entry[:-4]:
+                continue
+            entry_path = os.path.join(self.cachedir, entry)
+            try:
+                entry_stat = os.stat(entry_path)
+            except OSError:
+                continue
+            entries.append((entry_stat.st_mtime, entry_stat.st_size, entry_path))
+            self.total_bytes += entry_stat.st_size
+
+        now = time.time()
+        entries.sort()
+        for last_used, size, entry_path in entries:
+            if self.total_bytes <= 0.9 * self.max_bytes:
+                break
+            if now - last_used < self.grace_period:
+                # everything from here on was used too recently to throw out
+                break
+            try:
+                os.remove(entry_path)
+            except OSError:
+                continue
+            self.total_bytes -= size
+
+    def stats(self):
+        """
+        Get cache statistics
+
+        Return:
+            stats: dictionary with hits, misses, bytes and max_bytes
+        """
+        with self.lock:
+            return {"hits" : self.hits, "misses" : self.misses, "bytes" : self.total_bytes, "max_bytes" : self.max_bytes}
@@ -0,0 +1,168 @@
+"""
+Receiving Slack real time messaging (RTM) events with asyncio. Events are handled as soon as their
+websocket frame arrives (no polling), each one in its own task, and dropped connections are
+retried with exponential backoff and jitter.
+"""
+import json
+import time
+import random
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import websockets
+
+
+class RTMConnectError(Exception):
+    """
+    Slack wouldn't give us a websocket URL. fatal is True if there's no point trying again (e.g. bad token)
+    """
+    def __init__(self, message, fatal=False):
+        super(RTMConnectError, self).__init__(message)
+        self.fatal = fatal
+
+
+def get_slack_rtm_url(slack_client):
+    """
+    Ask Slack (rtm.connect) for a websocket URL
+
+    Args:
+        slack_client: a SlackClient instance
+    Return:
+        url: websocket URL
+    """
+    reply = slack_client.api_call("rtm.connect")
+    if not reply.get("ok", False):
+        error = reply.get("error", "unknown error")
+        raise RTMConnectError("rtm.connect failed: {0}".format(error), fatal=error in ("invalid_auth", "not_authed", "account_inactive"))
+    return reply["url"]
+
+
+class RTMReceiver(object):
+    """
+    Keeps a websocket to Slack open and hands every event to a (blocking) function. The handler
+    runs in a thread pool so it can take its time without holding up the websocket
+    """
+    def __init__(self, get_url, handle_event, handler_threads=1, min_backoff=1., max_backoff=60.):
+        """
+        Args:
+            get_url: function that returns the websocket URL to connect to (e.g. get_slack_rtm_url,
+                     or a fixed URL for testing). Can raise RTMConnectError
+            handle_event: function called with each event (a dict)
+            handler_threads: number of threads to run handle_event in. With 1, events are handled
+                             one at a time in the order they came in
+            min_backoff: seconds to wait before the first reconnect attempt
+            max_backoff: most seconds to wait between reconnect attempts
+        """
+        self.get_url = get_url
+        self.handle_event = handle_event
+        self.executor = ThreadPoolExecutor(max_workers=handler_threads)
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.tasks = set() # keep the tasks around until they're done
+        self.num_connects = 0
+
+    def get_backoff(self, attempt):
+        """
+        How long to wait before reconnect attempt number attempt (starting at 0). Doubles each
+        time up to max_backoff, and is randomized (between half and all of that) so lots of
+        clients don't all come back at once
+        """
+        backoff = min(self.max_backoff, self.min_backoff * 2**attempt)
+        return backoff / 2. + random.uniform(0, backoff / 2.)
+
+    async def _dispatch(self, event):
+        """
+        Handle one event in the thread pool
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self.executor, self.handle_event, event)
+        except Exception as e:
+            print("Error handling event {0}: {1}".format(event, e))
+
+    async def receive(self, websocket):
+        """
+        Read events off an open websocket until it closes or Slack says goodbye
+        """
+        async for frame in websocket:
+            try:
+                event = json.loads(frame)
+            except ValueError:
+                print("Got a malformed frame", frame)
+                continue
+            if event.get("type") == "goodbye":
+                # Slack wants us to reconnect
+                return
+            task = asyncio.ensure_future(self._dispatch(event))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def run(self):
+        """
+        Connect, receive, and reconnect forever (unless the token is bad)
+        """
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        while True:
+            try:
+                url = await loop.run_in_executor(None, self.get_url)
+                async with websockets.connect(url) as websocket:
+                    self.num_connects += 1
+                    attempt = 0
+                    await self.receive(websocket)
+            except RTMConnectError as e:
+                print(e)
+                if e.fatal:
+                    print("Connection Failed, invalid token?")
+                    return
+            except (OSError, asyncio.TimeoutError, websockets.exceptions.WebSocketException) as e:
+                print("Lost the RTM connection: {0}".format(e))
+            backoff = self.get_backoff(attempt)
+            attempt += 1
+            print("Reconnecting to RTM in {0:.1f} s".format(backoff))
+            await asyncio.sleep(backoff)
+
+    def run_forever(self):
+        """
+        Run the receiver in its own event loop. Blocks
+        """
+        asyncio.run(self.run())
+
+
+if __name__ == "__main__":
+    # demo against a local stand-in for Slack: it sends message events at random times, drops
+    # the connection every so often, and we time how long each event takes to get handled
+    import sys
+    import threading
+
+    num_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    port = 8765
+    latencies = []
+    done = threading.Event()
+
+    async def fake_slack(websocket, *args):
+        for i in range(25):
+            await asyncio.sleep(random.uniform(0.005, 0.05))
+            await websocket.send(json.dumps({"type" : "message", "text" : "<@U1234ASDF> time CLT", "user" : "U0000",
+                                             "channel" : "C0000", "sent" : time.time()}))
+        # hang up on them
+        await websocket.close()
+
+    def handle_event(event):
+        latencies.append(time.time() - event["sent"])
+        if len(latencies) >= num_messages:
+            done.set()
+
+    async def demo():
+        receiver = RTMReceiver(lambda: "ws://localhost:{0}".format(port), handle_event, min_backoff=0.05, max_backoff=0.2)
+        async with websockets.serve(fake_slack, "localhost", port):
+            receiver_task = asyncio.ensure_future(receiver.run())
+            await asyncio.get_running_loop().run_in_executor(None, done.wait)
+            receiver_task.cancel()
+        return receiver
+
+    receiver = asyncio.run(demo())
+    latencies.sort()
+    print("Handled {0} events over {1} connections. Median latency {2:.2f} ms, 95th percentile {3:.2f} ms "
+          "(polling every second averages 500 ms)".format(len(latencies), receiver.num_connects,
+          latencies[len(latencies)//2] * 1e3, latencies[int(len(latencies) * 0.95)] * 1e3))
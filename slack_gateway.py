@@ -0,0 +1,411 @@
+"""
+Everything the bot sends to Slack's Web API goes through here. Calls are queued and made by a
+few background threads over a pool of kept-alive connections, and every API method has its own
+token bucket so bursts get spread out instead of rate limited. Calls wait for their token in
+their method's own lane before they get a thread, so a method that is paused or busy never holds
+up the others. If Slack does say slow down (HTTP 429), the method waits out the Retry-After
+before trying again. Other failures get retried with exponential backoff, waiting off to the side
+so calls behind them in the lane can still go. Calls that post something are only retried if we
+know Slack never got them, so nothing gets posted twice.
+"""
+import time
+import heapq
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+
+import requests
+import requests.adapters
+
+# (calls per second, burst) for each method. Roughly Slack's published rate limit tiers
+default_rate_limits = {
+    "chat.postMessage" : (1., 5),
+    "files.upload" : (20/60., 3),
+}
+default_rate_limit = (50/60., 5) # everything else
+
+# methods where doing it twice means posting twice. If the connection dies after we sent one of
+# these, Slack might have done it already, so they don't get retried
+non_idempotent_methods = set(["chat.postMessage", "files.upload"])
+
+
+class SlackError(Exception):
+    """
+    Slack didn't do what we asked (e.g. channel_not_found), or we gave up retrying
+    """
+    pass
+
+
+class TokenBucket(object):
+    """
+    Lets calls through at a steady rate, with some room for bursts. Can be paused (e.g. for a
+    Retry-After). Safe to share between threads
+    """
+    def __init__(self, rate, burst):
+        """
+        Args:
+            rate: calls per second
+            burst: how many calls can go at once after a quiet spell
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last_time = time.time()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Wait for our turn
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.last_time) * self.rate)
+                self.last_time = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait_time)
+
+    def pause(self, seconds):
+        """
+        Don't let anything through for a while
+
+        Args:
+            seconds: how long
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+            self.tokens = 0
+
+
+class Lane(object):
+    """
+    The calls to one API method waiting their turn. Calls come out in the order they were first
+    made, but one waiting to be retried stays out of the way until its backoff is up, so it doesn't
+    hold up the ones behind it. Safe to share between threads
+    """
+    def __init__(self):
+        self.ready = [] # heap of (order made, call) that can go now
+        self.waiting = [] # heap of (not before, order made, call) backing off after a failure
+        self.num_calls = 0
+        self.condition = threading.Condition()
+
+    def put(self, call):
+        """
+        Add a new call, or one to retry. Retries go out no sooner than call["not_before"]
+
+        Args:
+            call: dict describing the call (see SlackGateway.call)
+        """
+        with self.condition:
+            if "order" not in call:
+                call["order"] = self.num_calls
+                self.num_calls += 1
+            if call["not_before"] > time.time():
+                heapq.heappush(self.waiting, (call["not_before"], call["order"], call))
+            else:
+                heapq.heappush(self.ready, (call["order"], call))
+            self.condition.notify()
+
+    def get(self):
+        """
+        Wait for the next call that can go
+
+        Return:
+            call: the earliest made call whose backoff (if any) is up
+        """
+        with self.condition:
+            while True:
+                now = time.time()
+                while len(self.waiting) > 0 and self.waiting[0][0] <= now:
+                    not_before, order, call = heapq.heappop(self.waiting)
+                    heapq.heappush(self.ready, (order, call))
+                if len(self.ready) > 0:
+                    return heapq.heappop(self.ready)[1]
+                # nothing to do until the next retry is due, or something new comes in
+                self.condition.wait(self.waiting[0][0] - now if len(self.waiting) > 0 else None)
+
+
+def print_result(future):
+    """
+    Done callback for calls nobody waits on: print what Slack said (or what went wrong)
+    """
+    try:
+        print(future.result())
+    except Exception as e:
+        print("Slack call failed: {0}".format(e))
+
+
+class SlackGateway(object):
+    """
+    Queues up Slack Web API calls and makes them in the background. Every call returns a
+    concurrent.futures.Future with Slack's reply (a dict), which raises SlackError if the call
+    didn't work.
+    """
+    def __init__(self, token, base_url="https://slack.com/api", workers=4, max_retries=5, timeout=60.,
+                 rate_limits=None):
+        """
+        Args:
+            token: Slack API token
+            base_url: where the Web API is (change it to test against a fake Slack)
+            workers: number of calls that can be in progress at once (and kept-alive connections)
+            max_retries: how many times to retry a call before giving up
+            timeout: seconds to wait for Slack to answer
+            rate_limits: dict of method -> (calls per second, burst) to use instead of default_rate_limits
+        """
+        self.base_url = base_url.rstrip("/")
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = "Bearer {0}".format(token)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+        self.rate_limits = dict(default_rate_limits)
+        if rate_limits is not None:
+            self.rate_limits.update(rate_limits)
+        self.buckets = {}
+        self.lanes = {} # method -> Lane of calls waiting for a token
+        self.lock = threading.Lock()
+
+    def get_bucket(self, method):
+        """
+        Get the token bucket for an API method
+        """
+        with self.lock:
+            bucket = self.buckets.get(method)
+            if bucket is None:
+                rate, burst = self.rate_limits.get(method, default_rate_limit)
+                bucket = TokenBucket(rate, burst)
+                self.buckets[method] = bucket
+            return bucket
+
+    def get_lane(self, method):
+        """
+        Get the lane of calls to an API method waiting for a token, starting the thread that
+        hands them out if it's the first call to that method
+        """
+        with self.lock:
+            lane = self.lanes.get(method)
+            if lane is None:
+                lane = Lane()
+                self.lanes[method] = lane
+                lane_thread = threading.Thread(target=self._run_lane, args=(method, lane))
+                lane_thread.daemon = True
+                lane_thread.start()
+            return lane
+
+    def call(self, method, file_data=None, **params):
+        """
+        Queue up an API call
+
+        Args:
+            method: API method (e.g. "chat.postMessage")
+            file_data: for uploads, a path to the file or the file contents (bytes)
+            params: arguments for the method. True/False get sent as "true"/"false"
+        Return:
+            future: a Future whose result is Slack's reply
+        """
+        data = {}
+        for key, value in params.items():
+            if isinstance(value, bool):
+                value = "true" if value else "false"
+            data[key] = value
+        future = Future()
+        self.get_lane(method).put({"method" : method, "data" : data, "file_data" : file_data, "future" : future,
+                                   "attempt" : 0, "not_before" : 0})
+        return future
+
+    def post_message(self, channel, text, **params):
+        """
+        Queue up a chat message as the bot
+
+        Args:
+            channel: channel name or ID
+            text: message
+            params: anything else chat.postMessage takes
+        Return:
+            future: a Future whose result is Slack's reply
+        """
+        params.setdefault("as_user", True)
+        return self.call("chat.postMessage", channel=channel, text=text, **params)
+
+    def upload_file(self, file_data, channels, filename, title):
+        """
+        Queue up a file upload
+
+        Args:
+            file_data: path to the file, or its contents (bytes)
+            channels: channel(s) to share it in, comma separated
+            filename: file name to show in Slack
+            title: title to show in Slack
+        Return:
+            future: a Future whose result is Slack's reply
+        """
+        return self.call("files.upload", file_data=file_data, channels=channels, filename=filename, title=title)
+
+    def _run_lane(self, method, lane):
+        """
+        Hand calls to one API method to the worker threads as tokens come free. Runs in its own
+        thread, so waiting on the token bucket only ever holds up this method
+        """
+        bucket = self.get_bucket(method)
+        while True:
+            call = lane.get()
+            bucket.acquire()
+            self.executor.submit(self._attempt, call)
+
+    def _attempt(self, call):
+        """
+        Make one try at an API call. Runs on a worker thread. If it needs retrying, it goes back
+        in its method's lane to wait out its backoff
+        """
+        method, data, file_data, future = call["method"], call["data"], call["file_data"], call["future"]
+        if call["attempt"] == 0 and not future.set_running_or_notify_cancel():
+            # nobody wants it anymore
+            return
+        try:
+            reply = self._post(method, data, file_data)
+        except SlackError as e:
+            future.set_exception(e)
+            return
+        except Exception as e:
+            future.set_exception(SlackError("{0}: {1}".format(method, e)))
+            return
+        if isinstance(reply, dict):
+            future.set_result(reply)
+            return
+
+        # try again later
+        error, backoff = reply
+        if call["attempt"] >= self.max_retries:
+            future.set_exception(SlackError("{0}: gave up after {1} tries ({2})".format(method, self.max_retries + 1, error)))
+            return
+        if backoff is None:
+            backoff = self.get_backoff(call["attempt"])
+        call["attempt"] += 1
+        call["not_before"] = time.time() + backoff
+        print("Retrying {0} ({1})".format(method, error))
+        self.get_lane(method).put(call)
+
+    def _post(self, method, data, file_data):
+        """
+        Send one request to Slack
+
+        Return:
+            reply: Slack's reply (a dict) if it worked, or (what went wrong, seconds to wait before
+                   retrying, or None for the usual backoff) if it's worth trying again. Raises
+                   SlackError if it isn't, including when a call that posts something might have
+                   gone through already
+        """
+        url = "{0}/{1}".format(self.base_url, method)
+        try:
+            if file_data is None:
+                response = self.session.post(url, data=data, timeout=self.timeout)
+            elif isinstance(file_data, bytes):
+                response = self.session.post(url, data=data, files={"file" : (data.get("filename", "file"), file_data)}, timeout=self.timeout)
+            else:
+                with open(file_data, "rb") as upload_file:
+                    response = self.session.post(url, data=data, files={"file" : upload_file}, timeout=self.timeout)
+        except requests.ConnectTimeout as e:
+            # never got connected, so Slack never saw it
+            return e, None
+        except requests.RequestException as e:
+            if method in non_idempotent_methods:
+                raise SlackError("{0}: {1}. Not retrying, it might have gone through".format(method, e))
+            return e, None
+        except IOError as e:
+            return e, None
+
+        if response.status_code == 429:
+            # slow down. Everyone using this method waits it out
+            self.get_bucket(method).pause(float(response.headers.get("Retry-After", 1)))
+            return "rate limited", 0
+        if response.status_code >= 500:
+            return "HTTP {0}".format(response.status_code), None
+
+        try:
+            reply = response.json()
+        except ValueError:
+            raise SlackError("{0}: HTTP {1} with no JSON".format(method, response.status_code))
+        if not reply.get("ok", False):
+            if reply.get("error") == "ratelimited":
+                self.get_bucket(method).pause(float(response.headers.get("Retry-After", 1)))
+                return "rate limited", 0
+            raise SlackError("{0}: {1}".format(method, reply.get("error", "unknown error")))
+        return reply
+
+    def get_backoff(self, attempt):
+        """
+        How long to wait after failed attempt number attempt (starting at 0). Doubles every time,
+        randomized so retries don't line up
+        """
+        backoff = min(30., 0.5 * 2**attempt)
+        return backoff / 2. + random.uniform(0, backoff / 2.)
+
+
+if __name__ == "__main__":
+    # try it out against a fake Slack that rate limits us and sometimes falls over
+    import sys
+    import json
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    num_calls = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    counts = {"calls" : 0, "429" : 0, "500" : 0}
+    counts_lock = threading.Lock()
+
+    class FakeSlack(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1" # keep-alive
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            roll = random.random()
+            with counts_lock:
+                counts["calls"] += 1
+                if roll < 0.1:
+                    counts["429"] += 1
+                elif roll < 0.15:
+                    counts["500"] += 1
+            if roll < 0.1:
+                self.send_response(429)
+                self.send_header("Retry-After", "1")
+                body = b""
+            elif roll < 0.15:
+                self.send_response(500)
+                body = b""
+            else:
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                body = json.dumps({"ok" : True, "ts" : str(time.time())}).encode("utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("localhost", 0), FakeSlack)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    gateway = SlackGateway("xoxb-fake", base_url="http://localhost:{0}/api".format(server.server_address[1]),
+                           rate_limits={"chat.postMessage" : (20., 5), "files.upload" : (10., 2)})
+    start_time = time.time()
+    futures = [gateway.post_message("#test", "Beep. Boop. {0}".format(i)) for i in range(num_calls)]
+    futures += [gateway.upload_file(b"\x89PNG fake", "#test", "fake.png", "Fake") for i in range(num_calls // 4)]
+    num_ok = 0
+    for future in futures:
+        try:
+            future.result()
+            num_ok += 1
+        except SlackError as e:
+            print(e)
+    print("{0} of {1} calls worked in {2:.1f} s. Fake Slack saw {3} requests ({4} rate limited, {5} errors)".format(
+          num_ok, len(futures), time.time() - start_time, counts["calls"], counts["429"], counts["500"]))
+    server.shutdown()
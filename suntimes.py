@@ -75,6 +75,25 @@ def sunset_time_response():
             "\nAnd 12 deg twilight is at {}".format(utc_to_multizone(twitime.datetime()) ) )
 
 
+def get_end_of_night():
+    """
+    When tonight's observing ends: 12 deg morning twilight at Gemini South. Uses its own
+    observer, so it's safe to call from any thread
+
+    Return:
+        twitime: morning twilight as a naive UTC datetime, or None if it isn't night right now
+    """
+    observer = _gemini()
+    observer.horizon = '-12'
+    observer.date = ephem.now()
+    twirise = observer.next_rising(ephem.Sun(), use_center=True)
+    twiset = observer.next_setting(ephem.Sun(), use_center=True)
+    if twiset < twirise:
+        # evening twilight comes first, so it's daytime
+        return None
+    return twirise.datetime()
+
+
 moon_phases = [ ":new_moon:", ":waxing_crescent_moon:", ":first_quarter_moon:", ":waxing_gibbous_moon:", ":full_moon:", ":waning_gibbous_moon:", ":last_quarter_moon:", ":waning_crescent_moon:"]
 moon_observer = _gemini()
     
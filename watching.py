@@ -0,0 +1,406 @@
+"""
+Watching only the parts of the GPIDATA trees we care about. A recursive watchdog observer puts an
+inotify watch on every raw and reduced directory, and every change anywhere ends up in our
+callback. Here we talk to inotify directly, with one inotify instance per tree, and only watch:
+
+    GPIDATA*/                         to see new objects show up
+    GPIDATA*/object/                  to see new autoreduced directories show up
+    GPIDATA*/object/autoreduced/...   everything under here (and autoreduced_kpop)
+
+Events are handed to a watchdog FileSystemEventHandler just like an Observer would. If we run
+out of inotify watches (or can't read events anymore), whatever we couldn't watch gets polled
+instead: object directories through the DatasetIndex, and subtrees in the top directory (e.g.
+autoreduced_kpop) by walking them. Linux only.
+"""
+import os
+import sys
+import time
+import errno
+import struct
+import ctypes
+import ctypes.util
+import threading
+
+import catchup
+
+from watchdog.events import FileCreatedEvent, DirCreatedEvent, FileModifiedEvent, FileDeletedEvent, \
+    DirDeletedEvent, FileMovedEvent, DirMovedEvent
+
+# from sys/inotify.h
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+event_header = struct.Struct("iIII") # wd, mask, cookie, len
+
+# what we want to hear about in the directories above the subtrees (only things being added and removed)
+parent_mask = IN_CREATE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE | IN_ONLYDIR
+# and inside the subtrees. Files being closed after writing counts as modified, not every write
+subtree_mask = IN_CREATE | IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE | IN_ONLYDIR
+
+_libc = None
+
+
+def get_libc():
+    """
+    Load the C library for the inotify calls. Raises OSError if there's no inotify
+    """
+    global _libc
+    if _libc is None:
+        if not sys.platform.startswith("linux"):
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "no inotify in this C library")
+        _libc = libc
+    return _libc
+
+
+class ScopedWatcher(threading.Thread):
+    """
+    Thread that reads inotify events for one GPIDATA tree and passes the ones under the watched
+    subtrees to an event handler. Directories get watched as they are created, so new objects
+    and new reductions are picked up without ever watching the raw data.
+    """
+    def __init__(self, event_handler, dataset_index, subtrees=("autoreduced", "autoreduced_kpop"), poll_seconds=60.,
+                 report_seconds=3600., poll_only=False):
+        """
+        Args:
+            event_handler: a watchdog FileSystemEventHandler (e.g. NewImagePoster) to pass events to
+            dataset_index: the datasets.DatasetIndex of the tree. Its rootdir is what we watch, and
+                           it's what we poll if we can't watch something
+            subtrees: names of the directories (in the tree or in each object directory) to watch everything under
+            poll_seconds: how often to poll the parts of the tree we couldn't watch
+            report_seconds: how often to print how many events we've handled
+            poll_only: if True, don't watch anything, just poll the whole tree through the DatasetIndex
+                       (e.g. for network filesystems where inotify doesn't work)
+        """
+        super(ScopedWatcher, self).__init__()
+        self.daemon = True
+        self.event_handler = event_handler
+        self.dataset_index = dataset_index
+        self.rootdir = dataset_index.rootdir
+        self.subtrees = set(subtrees)
+        self.poll_seconds = poll_seconds
+        self.report_seconds = report_seconds
+
+        self.lock = threading.Lock()
+        self.wd_paths = {} # inotify watch descriptor -> directory
+        self.path_wds = {} # directory -> watch descriptor
+        self.out_of_watches = False
+        self.poll_only = poll_only
+        self.poll_all = False # couldn't even watch the top directory
+        self.poll_objects = set() # objects we couldn't watch everything of
+        self.poll_subtrees = {} # subtrees in the top directory we couldn't watch everything of -> when we started polling
+        self.subtree_files = {} # subtree -> {path : modification time} from the last time it was polled
+        self.resync = False # inotify dropped events, so check everything once
+
+        self.num_events = 0 # raw inotify events read
+        self.num_handled = 0 # events passed on to the event handler
+        self.startup_time = 0
+
+        if poll_only:
+            self.poll_everything()
+            return
+        libc = get_libc()
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def _get_depth_and_scope(self, path):
+        """
+        Where a directory is in the tree
+
+        Return:
+            depth: 0 for the top directory, 1 for an object directory, etc
+            in_subtree: True if it's one of the subtrees or under one
+        """
+        relpath = os.path.relpath(path, self.rootdir)
+        if relpath == os.curdir:
+            return 0, False
+        path_args = relpath.split(os.path.sep)
+        return len(path_args), len(self.subtrees.intersection(path_args[:2])) > 0
+
+    def _add_watch(self, dirpath, mask):
+        """
+        Watch one directory
+
+        Return:
+            watched: False if we couldn't (out of watches or it's gone)
+        """
+        with self.lock:
+            if dirpath in self.path_wds:
+                return True
+        wd = get_libc().inotify_add_watch(self.fd, os.fsencode(dirpath), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                if not self.out_of_watches:
+                    print("Ran out of inotify watches at {0}. Polling what we can't watch every {1} s. "
+                          "Raise fs.inotify.max_user_watches to avoid this".format(dirpath, self.poll_seconds))
+                self.out_of_watches = True
+                depth, in_subtree = self._get_depth_and_scope(dirpath)
+                top_name = os.path.relpath(dirpath, self.rootdir).split(os.path.sep)[0]
+                if depth == 0:
+                    self.poll_everything()
+                elif top_name in self.subtrees:
+                    # not an object, the DatasetIndex doesn't know about it
+                    self.poll_subtree(os.path.join(self.rootdir, top_name))
+                else:
+                    self.poll_objects.add(top_name)
+            return False
+        with self.lock:
+            self.wd_paths[wd] = dirpath
+            self.path_wds[dirpath] = wd
+        return True
+
+    def watch_dir(self, dirpath, report_contents=False):
+        """
+        Start watching a directory, and what's under it if it's in (or is) a subtree
+
+        Args:
+            dirpath: path to directory
+            report_contents: if True, pass on created events for any files already in it (they
+                             might have shown up before the watch was in place)
+        """
+        depth, in_subtree = self._get_depth_and_scope(dirpath)
+        if not in_subtree:
+            if depth > 1 or not self._add_watch(dirpath, parent_mask):
+                return
+            try:
+                entries = [entry for entry in os.scandir(dirpath) if entry.is_dir(follow_symlinks=False)]
+            except OSError:
+                return
+            for entry in entries:
+                if depth == 0 or entry.name in self.subtrees:
+                    self.watch_dir(entry.path, report_contents=report_contents)
+            return
+
+        # everything under here
+        to_watch = [dirpath]
+        while len(to_watch) > 0:
+            subdir = to_watch.pop()
+            if not self._add_watch(subdir, subtree_mask):
+                continue
+            try:
+                entries = list(os.scandir(subdir))
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        to_watch.append(entry.path)
+                    elif report_contents:
+                        self._handle(FileCreatedEvent(entry.path))
+                except OSError:
+                    continue
+
+    def unwatch_dir(self, dirpath):
+        """
+        Stop watching a directory (e.g. it was moved away) and everything under it
+        """
+        prefix = dirpath + os.path.sep
+        with self.lock:
+            gone = [path for path in self.path_wds if path == dirpath or path.startswith(prefix)]
+            for path in gone:
+                wd = self.path_wds.pop(path)
+                del self.wd_paths[wd]
+                get_libc().inotify_rm_watch(self.fd, wd)
+
+    def start(self):
+        """
+        Put the watches in place, then start reading events
+        """
+        poll_thread = threading.Thread(target=self._poll_loop)
+        poll_thread.daemon = True
+        if self.poll_only:
+            print("Polling {0} every {1} s".format(self.rootdir, self.poll_seconds))
+            poll_thread.start()
+            return
+
+        start_time = time.time()
+        self.watch_dir(self.rootdir)
+        self.startup_time = time.time() - start_time
+        print("Watching {0} directories in {1} (set up in {2:.1f} s)".format(len(self.path_wds), self.rootdir, self.startup_time))
+        super(ScopedWatcher, self).start()
+        poll_thread.start()
+
+    def poll_everything(self):
+        """
+        Give up on watching and poll the whole tree: every object through the DatasetIndex, and the
+        subtrees in the top directory by walking them
+        """
+        self.poll_all = True
+        for name in self.subtrees:
+            self.poll_subtree(os.path.join(self.rootdir, name))
+
+    def poll_subtree(self, subtree):
+        """
+        Start polling a subtree in the top directory (e.g. autoreduced_kpop). Files in it that
+        change from now on get reported
+
+        Args:
+            subtree: path to the subtree
+        """
+        with self.lock:
+            if subtree not in self.poll_subtrees:
+                self.poll_subtrees[subtree] = time.time()
+
+    def _find_subtree_changes(self, subtree, since):
+        """
+        Walk a subtree and report what changed since the last walk. The first walk reports
+        files modified after since
+
+        Args:
+            subtree: path to the subtree
+            since: when we started polling it
+        """
+        mtimes = {}
+        def record_mtime(entry):
+            mtimes[entry.path] = entry.stat().st_mtime
+            return False
+        catchup.parallel_walk(subtree, record_mtime)
+
+        previous = self.subtree_files.get(subtree)
+        self.subtree_files[subtree] = mtimes
+        if previous is None:
+            previous = dict((path, mtime) for path, mtime in mtimes.items() if mtime < since)
+        for path in previous:
+            if path not in mtimes:
+                self._handle(FileDeletedEvent(path))
+        for path, mtime in mtimes.items():
+            if path not in previous:
+                self._handle(FileCreatedEvent(path))
+            elif mtime != previous[path]:
+                self._handle(FileModifiedEvent(path))
+
+    def stats(self):
+        """
+        Return:
+            stats: dict of number of watches, startup time, and events read and handled
+        """
+        return {"watches" : len(self.path_wds), "startup_time" : self.startup_time,
+                "events" : self.num_events, "handled" : self.num_handled}
+
+    def _handle(self, event):
+        """
+        Pass an event on to the event handler
+        """
+        self.num_handled += 1
+        try:
+            self.event_handler.dispatch(event)
+        except Exception as e:
+            print("Error handling {0}: {1}".format(event, e))
+
+    def run(self):
+        buffer_size = 64 * 1024
+        while True:
+            try:
+                data = os.read(self.fd, buffer_size)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                print("Can't read file events for {0} anymore ({1}). Polling everything every {2} s instead".format(
+                      self.rootdir, e, self.poll_seconds))
+                self.poll_everything()
+                return
+
+            moved_from = {} # cookie -> (path, is_dir) waiting for its other half
+            events = []
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, name_len = event_header.unpack_from(data, offset)
+                offset += event_header.size
+                name = data[offset:offset + name_len].rstrip(b"\0")
+                offset += name_len
+                events.append((wd, mask, cookie, os.fsdecode(name)))
+            self.num_events += len(events)
+
+            for wd, mask, cookie, name in events:
+                if mask & IN_Q_OVERFLOW:
+                    print("Missed some file events in {0}. Checking everything".format(self.rootdir))
+                    self.resync = True
+                    continue
+                with self.lock:
+                    dirpath = self.wd_paths.get(wd)
+                    if mask & IN_IGNORED and dirpath is not None:
+                        # directory is gone
+                        del self.wd_paths[wd]
+                        self.path_wds.pop(dirpath, None)
+                        continue
+                if dirpath is None or len(name) == 0:
+                    continue
+                path = os.path.join(dirpath, name)
+                is_dir = mask & IN_ISDIR != 0
+                depth, in_subtree = self._get_depth_and_scope(path)
+                if not in_subtree and depth > 1:
+                    # some other directory in an object directory
+                    continue
+
+                if mask & IN_CREATE:
+                    if is_dir:
+                        self._handle(DirCreatedEvent(path))
+                        self.watch_dir(path, report_contents=True)
+                    else:
+                        self._handle(FileCreatedEvent(path))
+                elif mask & IN_CLOSE_WRITE:
+                    self._handle(FileModifiedEvent(path))
+                elif mask & IN_MOVED_FROM:
+                    moved_from[cookie] = (path, is_dir)
+                    if is_dir:
+                        self.unwatch_dir(path)
+                elif mask & IN_MOVED_TO:
+                    src = moved_from.pop(cookie, None)
+                    if src is not None:
+                        self._handle(DirMovedEvent(src[0], path) if is_dir else FileMovedEvent(src[0], path))
+                    else:
+                        # moved in from somewhere we don't watch
+                        self._handle(DirCreatedEvent(path) if is_dir else FileCreatedEvent(path))
+                    if is_dir:
+                        self.watch_dir(path, report_contents=True)
+                elif mask & IN_DELETE:
+                    self._handle(DirDeletedEvent(path) if is_dir else FileDeletedEvent(path))
+
+            # moved somewhere we don't watch
+            for path, is_dir in moved_from.values():
+                self._handle(DirDeletedEvent(path) if is_dir else FileDeletedEvent(path))
+
+    def _poll_loop(self):
+        """
+        Every so often, poll whatever we couldn't watch, and say how we're doing
+        """
+        last_report = time.time()
+        while True:
+            time.sleep(self.poll_seconds)
+            if self.poll_all or self.resync:
+                objnames = None
+            elif len(self.poll_objects) > 0:
+                objnames = list(self.poll_objects)
+            else:
+                objnames = []
+            self.resync = False
+
+            if objnames is None or len(objnames) > 0:
+                added, removed, modified = self.dataset_index.find_changes(objnames)
+                for path in removed:
+                    self._handle(FileDeletedEvent(path))
+                for path in added:
+                    self._handle(FileCreatedEvent(path))
+                for path in modified:
+                    self._handle(FileModifiedEvent(path))
+            with self.lock:
+                poll_subtrees = list(self.poll_subtrees.items())
+            for subtree, since in poll_subtrees:
+                self._find_subtree_changes(subtree, since)
+
+            if time.time() - last_report >= self.report_seconds:
+                last_report = time.time()
+                print("{0}: {1} watches, {2} events read, {3} handled".format(self.rootdir, len(self.path_wds), self.num_events, self.num_handled))